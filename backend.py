@@ -0,0 +1,232 @@
+#! /usr/bin/env python
+import time
+import itertools
+import pandas as pd
+from collections import OrderedDict
+from instrumentation import instruments
+
+
+class QueryBackend():
+    """
+    Base class for the ways of sending cypher to the graph. A backend is passed around
+    wherever a py2neo graph used to be, and Env.py2neo_py2_and_py3 hands the query to it
+    """
+    name = None
+
+    def run(self, query, parameters=None):
+        """
+        :param query: the cypher query to be ran
+        :param parameters: optional dictionary of query parameters
+        :return: Pandas DataFrame
+        """
+        raise NotImplementedError
+
+    def stream(self, query, parameters=None, chunk_size=10000):
+        """
+        Run the query and yield the result a chunk at a time rather than all at once
+
+        :param chunk_size: maximum number of rows in each DataFrame
+        :return: generator of Pandas DataFrames
+        """
+        df = self.run(query, parameters)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+
+    def profile(self, query, parameters=None):
+        """
+        Run the query under PROFILE and add up the database hits of every step of the plan
+
+        :return: total db hits, or None when the backend can't report the profiled plan
+        """
+        return None
+
+    def close(self):
+        pass
+
+
+def total_db_hits(plan):
+    """
+    Sum the db hits over a profiled plan and all of its children. Newer neo4j drivers give
+    the plan as a dictionary, older ones as an object
+
+    :param plan: profiled plan from a result summary
+    :return: int
+    """
+    if plan is None:
+        return 0
+    if isinstance(plan, dict):
+        return plan.get('dbHits', 0) + sum(total_db_hits(child) for child in plan.get('children', []))
+    return plan.db_hits + sum(total_db_hits(child) for child in plan.children)
+
+
+def server_seconds(summary):
+    """
+    Time the server spent on a query, from the result summary of the neo4j driver: the time
+    until the first record was available plus the time taken to stream them all
+
+    :return: seconds, or None when the summary doesn't say
+    """
+    available = getattr(summary, 'result_available_after', None)
+    consumed = getattr(summary, 'result_consumed_after', None)
+    if available is None or consumed is None:
+        return None
+    return (available + consumed) / 1000.0
+
+
+def records_to_frames(records, columns, chunk_size):
+    """
+    Turn an iterator of records into DataFrames of at most chunk_size rows. The values are
+    appended to one list per column, so no dictionary is built for each row and only one
+    chunk of records is held in memory at a time
+
+    :param records: iterator of sequences of values, in the order of columns
+    :param columns: list of column names
+    :param chunk_size: maximum number of rows in each DataFrame
+    :return: generator of Pandas DataFrames
+    """
+    buffers = [[] for _ in columns]
+    rows = 0
+    for record in records:
+        for buffer, value in zip(buffers, record):
+            buffer.append(value)
+        rows += 1
+        if rows == chunk_size:
+            yield pd.DataFrame(OrderedDict(zip(columns, buffers)), columns=columns)
+            buffers = [[] for _ in columns]
+            rows = 0
+    if rows:
+        yield pd.DataFrame(OrderedDict(zip(columns, buffers)), columns=columns)
+
+
+class HttpBackend(QueryBackend):
+    """
+    Runs queries through a py2neo Graph over the HTTP REST endpoint. The py2neo version is
+    checked once, when the backend is created, and the matching fetch and stream methods
+    are bound in place of a version check on every query
+    """
+    name = 'http'
+
+    def __init__(self, graph, py2neo_version=None):
+        """
+        :param graph: py2neo Graph
+        :param py2neo_version: version string of py2neo, read from the library if not given
+        :raises ValueError: for a version of py2neo that isn't supported
+        """
+        if py2neo_version is None:
+            import py2neo
+            py2neo_version = py2neo.__version__
+        self.graph = graph
+        if py2neo_version.startswith('2.'):
+            self.fetch, self.stream_frames = self.fetch_v2, self.stream_frames_v2
+        elif py2neo_version.startswith('3.'):
+            self.fetch, self.stream_frames = self.fetch_v3, self.stream_frames_v3
+        else:
+            raise ValueError('Unsupported py2neo version ' + py2neo_version)
+
+    def fetch_v2(self, query, parameters):
+        # Older version of py2neo, more complicated syntax
+        graph_result = self.graph.cypher.execute(query, parameters)
+        return graph_result.records, graph_result.columns
+
+    def fetch_v3(self, query, parameters):
+        # Newer version of py2neo, easier syntax, the records are dictionaries
+        return self.graph.data(query, parameters), None
+
+    def run(self, query, parameters=None):
+        start = time.time()
+        records, columns = self.fetch(query, parameters)
+        fetched = time.time()
+        df = pd.DataFrame(records, columns=columns)
+        # The REST endpoint doesn't report how long the server spent on the query
+        instruments.record_query(self.name, query, df, fetched - start, time.time() - fetched)
+        return df
+
+    def stream(self, query, parameters=None, chunk_size=10000):
+        return instruments.metered_stream(self.name, query, self.stream_frames(query, parameters, chunk_size))
+
+    def stream_frames_v2(self, query, parameters, chunk_size):
+        # Older version of py2neo, records know their columns through their producer
+        records = iter(self.graph.cypher.stream(query, parameters))
+        first = next(records, None)
+        if first is None:
+            return
+        for df in records_to_frames(itertools.chain([first], records),
+                                    first.__producer__.columns, chunk_size):
+            yield df
+
+    def stream_frames_v3(self, query, parameters, chunk_size):
+        # Newer version of py2neo, the cursor reads records from the response as it goes
+        cursor = self.graph.run(query, parameters)
+        for df in records_to_frames(cursor, cursor.keys(), chunk_size):
+            yield df
+
+
+class BoltBackend(QueryBackend):
+    """
+    Runs queries over the binary Bolt protocol using the official neo4j driver. The driver
+    keeps a pool of open connections, each query borrows one for a short-lived session and
+    hands it back, so many small queries don't pay for a new connection each time. Sessions
+    are not shared between threads, which keeps this safe for Cob.max_workers above 1
+    """
+    name = 'bolt'
+
+    def __init__(self, uri, user, password, pool_size=50, keep_alive=True, max_retries=3,
+                 retry_delay=1.0):
+        """
+        :param uri: bolt address, e.g. 'bolt://server:7687'
+        :param pool_size: maximum number of connections held open by the driver
+        :param keep_alive: send TCP keep-alive on pooled connections
+        :param max_retries: number of times a query is retried after a transient error
+        :param retry_delay: seconds to wait before the first retry, doubled after each one
+        """
+        # neo4j is only needed when bolt is selected in the configuration file
+        import neo4j
+        from neo4j import exceptions
+        self.transient_errors = (exceptions.TransientError, exceptions.ServiceUnavailable,
+                                 exceptions.SessionExpired)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.driver = neo4j.GraphDatabase.driver(uri, auth=(user, password),
+                                                 max_connection_pool_size=pool_size,
+                                                 keep_alive=keep_alive)
+        # Fail now rather than on the first real query if the server can't be reached
+        self.run('RETURN 1')
+
+    def run(self, query, parameters=None):
+        attempt = 0
+        while True:
+            try:
+                with self.driver.session() as session:
+                    start = time.time()
+                    result = session.run(query, parameters or {})
+                    records = [record.values() for record in result]
+                    fetched = time.time()
+                    df = pd.DataFrame(records, columns=result.keys())
+                    if instruments.enabled:
+                        instruments.record_query(self.name, query, df, fetched - start,
+                                                 time.time() - fetched, server_seconds(result.consume()))
+                    return df
+            except self.transient_errors:
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+
+    def stream(self, query, parameters=None, chunk_size=10000):
+        return instruments.metered_stream(self.name, query, self.stream_frames(query, parameters, chunk_size))
+
+    def stream_frames(self, query, parameters, chunk_size):
+        # Transient errors are not retried here, the chunks already yielded can't be taken back
+        with self.driver.session() as session:
+            result = session.run(query, parameters or {})
+            for df in records_to_frames((record.values() for record in result), result.keys(),
+                                        chunk_size):
+                yield df
+
+    def profile(self, query, parameters=None):
+        with self.driver.session() as session:
+            summary = session.run('PROFILE ' + query, parameters or {}).consume()
+        return total_db_hits(summary.profile)
+
+    def close(self):
+        self.driver.close()
@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+"""
+Process every offboarding file of a directory, or matching a glob, in one session. The
+files share one connection to the graph, and an ID that appears in several files is only
+looked up once. Each file gets its own output, named like the single file run names it.
+
+    python batch.py yaml_directory yaml_file offboarding_files output_directory
+    python batch.py yaml_directory yaml_file "offboarding_files/*_2024_*.csv" output_directory
+"""
+import os
+import glob
+import logging
+import argparse
+import datetime
+from collections import OrderedDict
+from instrumentation import instruments, configure_logging
+
+# pandas and py2neo come in with cob and env, which are only imported once a run starts,
+# so finding the input files doesn't pay for them. See cli.py
+
+log = logging.getLogger(__name__)
+
+# Extensions Cob.iter_input knows how to read
+INPUT_EXTENSIONS = ('.csv', '.parquet', '.feather')
+
+
+def find_input_files(patterns):
+    """
+    :param patterns: list of directories, files or glob patterns
+    :return: list of input file paths, in name order, each listed once
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(os.path.join(pattern, name) for name in sorted(os.listdir(pattern))
+                         if os.path.splitext(name)[1].lower() in INPUT_EXTENSIONS)
+        else:
+            paths.extend(sorted(glob.glob(pattern)))
+    return list(OrderedDict.fromkeys(paths))
+
+
+def output_file_name(input_path, timestamp, extension='.csv'):
+    # <input name>_output_<timestamp><extension>, as in the __main__ block of cob.py
+    return os.path.basename(input_path).split('.')[0] + '_output' + timestamp + extension
+
+
+def union_inputs(grouped_inputs):
+    """
+    Merge the grouped IDs of several input files
+
+    :param grouped_inputs: iterable of dictionaries of COBSYSTEM to list of COBSYSTEMIDs
+    :return: OrderedDict of COBSYSTEM to list of COBSYSTEMIDs, each ID listed once
+    """
+    union = OrderedDict()
+    for grouped in grouped_inputs:
+        for cobsystem, cobsystemid_list in grouped.items():
+            union.setdefault(cobsystem, OrderedDict()).update(OrderedDict.fromkeys(cobsystemid_list))
+    return OrderedDict((cobsystem, list(ids)) for cobsystem, ids in union.items())
+
+
+def results_for_input(cob, results, grouped):
+    """
+    Pick the rows of one input file out of the lookup results of all the files
+
+    :param cob: Cob, whose combine_ucl_frames normalises and de-duplicates the rows
+    :param results: dictionary of COBSYSTEM to lookup result, from Cob.lookup_cobsystems or
+    expand_results
+    :param grouped: dictionary of COBSYSTEM to list of COBSYSTEMIDs of the file
+    :return: Pandas DataFrame with the UCL_COLUMNS columns, and HOP_COLUMN after expand_results
+    """
+    df_list = []
+    for cobsystem, cobsystemid_list in grouped.items():
+        if cobsystem in results:
+            df = results[cobsystem]
+            df_list.append(df[df['input_cobsystemid'].isin(set(cobsystemid_list))])
+    return cob.combine_ucl_frames(df_list)
+
+
+def expand_results(cob, results):
+    """
+    Follow the UCLs of the lookup results of every file for cob.max_hops hops, see
+    Cob.expand_hops. The files are expanded together, so a node reached from several files
+    is only queried once
+
+    :param cob: Cob connected to the graph
+    :param results: dictionary of COBSYSTEM to lookup result, from Cob.lookup_cobsystems
+    :return: OrderedDict of COBSYSTEM to the rows reached from its inputs, with HOP_COLUMN
+    """
+    import pandas as pd
+    from cob import UCL_COLUMNS, HOP_COLUMN
+    # the node labels each COBSYSTEM's inputs have in the input_cobsystem column
+    labels = OrderedDict((cobsystem, set(df['input_cobsystem'].dropna().unique()))
+                         for cobsystem, df in results.items())
+    df_list = cob.expand_hops(results.values())
+    df = pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame(columns=UCL_COLUMNS + [HOP_COLUMN])
+    del df_list[:]
+    return OrderedDict((cobsystem, df[df['input_cobsystem'].isin(labels[cobsystem])])
+                       for cobsystem in results)
+
+
+def write_stages(cob, grouped, df, stages, input_path, output_directory, timestamp,
+                 output_format='csv', compression='snappy'):
+    """
+    Run enrichment stages of Cob.functions on the lookup result of one input file, and write
+    each to its own output, <input name>_output<timestamp>_<stage><extension>
+
+    :param grouped: dictionary of COBSYSTEM to list of COBSYSTEMIDs of the file
+    :param df: lookup result of the file, used as the input_plus_ucl_cob stage
+    :param stages: names of the stages to run, e.g. Config.stages
+    :return: OrderedDict of stage name to output path, for the stages that succeeded. The
+    stages that failed are recorded in cob.failed_stages
+    """
+    from cob import LABEL_COLUMNS
+    from output import OutputWriter, OUTPUT_EXTENSIONS
+    pipeline = cob.functions(grouped)
+    pipeline.set_result('input_plus_ucl_cob', df)
+    outputs = OrderedDict()
+    for stage, df_stage in pipeline.run(stages).items():
+        if stage == 'input_plus_ucl_cob':
+            continue
+        outputs[stage] = os.path.join(output_directory, output_file_name(
+            input_path, timestamp, '_' + stage + OUTPUT_EXTENSIONS[output_format]))
+        with OutputWriter(outputs[stage], output_format, None, compression, LABEL_COLUMNS) as writer:
+            writer.write(df_stage)
+    if pipeline.failed:
+        log.warning('%s is missing the stages that failed: %s', input_path, ', '.join(pipeline.failed))
+        cob.failed_stages[input_path] = list(pipeline.failed)
+    return outputs
+
+
+def run_batch(cob, input_paths, output_directory, timestamp=None, output_format='csv',
+              partition_by=None, compression='snappy', stages=()):
+    """
+    Look up the IDs of every input file together, then write one output per file, and one
+    per file and stage when stages are given, see write_stages. With cob.max_hops other
+    than 1 the UCLs are followed further, see expand_results
+
+    :param cob: Cob connected to the graph
+    :param input_paths: list of input file paths
+    :param output_directory: directory the outputs are written to
+    :param timestamp: suffix of the output names, the current time by default
+    :param output_format: 'parquet' or 'csv', see OutputWriter
+    :param partition_by: optional column to split each output by, see OutputWriter
+    :param stages: names of enrichment stages to run on each file's result
+    :return: OrderedDict of input path to output path
+    """
+    from cob import LABEL_COLUMNS, UCL_COLUMNS, HOP_COLUMN
+    from output import OutputWriter, OUTPUT_EXTENSIONS
+    timestamp = timestamp or datetime.datetime.now().strftime("_%Y_%m_%d_%H_%M")
+    cob.failed_stages = OrderedDict()
+    per_file = OrderedDict((path, cob.load_input_grouped(path=path)) for path in input_paths)
+    union = union_inputs(per_file.values())
+    requested = sum(len(ids) for grouped in per_file.values() for ids in grouped.values())
+    unique = sum(len(ids) for ids in union.values())
+    log.info('%d files, %d IDs of which %d are unique', len(per_file), requested, unique)
+
+    results = cob.lookup_cobsystems(union)
+    columns = UCL_COLUMNS
+    if cob.max_hops != 1:
+        results = expand_results(cob, results)
+        columns = UCL_COLUMNS + [HOP_COLUMN]
+    outputs = OrderedDict()
+    for path, grouped in per_file.items():
+        missing = [cobsystem for cobsystem in grouped if cobsystem in cob.failed_cobsystems]
+        if missing:
+            log.warning('%s is missing the COBSYSTEMs whose lookup failed: %s', path, ', '.join(missing))
+        extension = '' if partition_by else OUTPUT_EXTENSIONS[output_format]
+        outputs[path] = os.path.join(output_directory, output_file_name(path, timestamp, extension))
+        with instruments.timer('write_output', file=os.path.basename(path)) as fields:
+            with OutputWriter(outputs[path], output_format, partition_by, compression,
+                              LABEL_COLUMNS, columns,
+                              metadata=dict(cob.result_settings(), graph_version=cob.graph_version,
+                                            input=path)) as writer:
+                df = results_for_input(cob, results, grouped)
+                writer.write(df)
+            fields['rows'] = writer.rows
+        if stages:
+            write_stages(cob, grouped, df, stages, path, output_directory, timestamp,
+                         output_format, compression)
+    return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offboard every input file of a directory or glob')
+    parser.add_argument('yaml_directory')
+    parser.add_argument('yaml_file')
+    parser.add_argument('inputs', nargs='+', help='input directories, files or glob patterns')
+    parser.add_argument('output_directory')
+    args = parser.parse_args()
+
+    from env import Env
+    from cob import Cob
+    env_class = Env(args.yaml_directory, args.yaml_file, '', '')
+    configure_logging(env_class.config.log_level)
+    instruments.configure(env_class.config)
+    input_paths = find_input_files(args.inputs)
+    if not input_paths:
+        parser.error('no input files found in ' + ', '.join(args.inputs))
+    env_class.graph = env_class.connectToYamlGraph()
+    cob_class = Cob.from_config(env_class)
+    cob_class.graph = env_class.graph
+    config = env_class.config
+    run_batch(cob_class, input_paths, args.output_directory, output_format=config.output_format,
+              partition_by=config.output_partition_by, compression=config.output_compression,
+              stages=config.stages)
+    if cob_class.checkpoint is not None and not cob_class.failed_cobsystems and not cob_class.failed_stages:
+        cob_class.checkpoint.clear()
@@ -0,0 +1,472 @@
+#! /usr/bin/env python
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import datetime
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+from collections import defaultdict, OrderedDict
+from cob import Cob, UCL_COLUMNS, INPUT_COLUMNS, HOP_COLUMN
+from backend import QueryBackend
+from ucl_index import UclIndex
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident memory of the current process in MB
+
+    :return: float
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        return peak / 1024.0 ** 2 if sys.platform == 'darwin' else peak / 1024.0
+    except ImportError:
+        # Windows has no resource module, psutil reports the peak working set instead
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024.0 ** 2
+
+
+def synthetic_ucl_frames(n_rows, n_cobsystems=15, seed=0):
+    """
+    Build a list of per-COBSYSTEM lookup results, shaped like the output of
+    Cob.input_cob_get_ucl_and_ucl_children, totalling roughly n_rows rows
+
+    :param n_rows: total number of rows across all the frames
+    :param n_cobsystems: number of frames, one per input COBSYSTEM
+    :param seed: random seed so repeated runs build the same data
+    :return: list of Pandas DataFrames
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.array(['SYS%dParty' % i for i in range(n_cobsystems)] + ['DBCATParty'])
+    rows_per_frame = n_rows // n_cobsystems
+    df_list = []
+    for i in range(n_cobsystems):
+        input_ids = rng.randint(0, rows_per_frame, rows_per_frame).astype(str)
+        df_list.append(pd.DataFrame({
+            'UCL_ID': rng.randint(0, rows_per_frame // 10 + 1, rows_per_frame).astype(str),
+            'input_cobsystemid': input_ids,
+            'input_cobsystem': labels[i],
+            'COBSYSTEMID': rng.randint(0, rows_per_frame, rows_per_frame).astype(str),
+            'COBSYSTEM': labels[rng.randint(0, len(labels), rows_per_frame)],
+        }, columns=UCL_COLUMNS))
+    return df_list
+
+
+def concat_in_loop(df_list):
+    """
+    The accumulation populate_cob used to do, kept here as the baseline for comparison
+    """
+    for j, df_cobsystem in enumerate(df_list):
+        if j == 0:
+            df = df_cobsystem
+        else:
+            df = pd.concat([df, df_cobsystem])
+    df.replace({'DBCATParty': 'DBCAT'}, inplace=True)
+    df.drop_duplicates(inplace=True)
+    return df
+
+
+def _measure_combine(method, n_rows, queue):
+    df_list = synthetic_ucl_frames(n_rows)
+    before = peak_rss_mb()
+    if method == 'concat_in_loop':
+        df = concat_in_loop(df_list)
+    else:
+        df = Cob().combine_ucl_frames(df_list)
+    del df_list
+    queue.put({'method': method,
+               'rows': len(df),
+               'peak_rss_mb_before': round(before, 1),
+               'peak_rss_mb_after': round(peak_rss_mb(), 1),
+               'result_mb': round(float(df.memory_usage(deep=True).sum()) / 1024.0 ** 2, 1)})
+
+
+def memory_report(n_rows=1000000):
+    """
+    Compare the peak memory of the old and new ways of combining lookup results in
+    populate_cob. Each method runs in its own process, as the peak RSS of a process
+    never goes down and the first run would hide the second
+
+    :param n_rows: number of synthetic result rows
+    :return: list of dictionaries, one per method
+    """
+    report = []
+    for method in ['concat_in_loop', 'combine_ucl_frames']:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure_combine, args=(method, n_rows, queue))
+        process.start()
+        report.append(queue.get())
+        process.join()
+    return report
+
+
+def synthetic_input(n_rows, n_cobsystems=15, seed=0):
+    """
+    Build an input file DataFrame with COBSYSTEM and numeric COBSYSTEMID columns
+
+    :param n_rows: number of rows
+    :param n_cobsystems: number of distinct COBSYSTEMs
+    :param seed: random seed so repeated runs build the same data
+    :return: Pandas DataFrame
+    """
+    rng = np.random.RandomState(seed)
+    cobsystems = np.array(['SYS%d' % i for i in range(n_cobsystems)])
+    return pd.DataFrame({'COBSYSTEM': cobsystems[rng.randint(0, n_cobsystems, n_rows)],
+                         'COBSYSTEMID': rng.randint(0, n_rows, n_rows)})
+
+
+def dataframe_to_dict_loop(df):
+    """
+    The itertuples loop Cob.dataframe_to_dict used to run, kept here as the baseline for comparison
+    """
+    mydict = defaultdict(list)
+    for (key, val) in df.itertuples(index=False):
+        mydict[key].append(str(val))
+    return mydict
+
+
+def time_call(function, *args, **kwargs):
+    """
+    :return: tuple of (result, seconds taken by the call)
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def grouping_report(sizes=(10000, 100000, 1000000)):
+    """
+    Time the old row-by-row and the new vectorised Cob.dataframe_to_dict on inputs of
+    several sizes
+
+    :param sizes: numbers of input rows
+    :return: list of dictionaries, one per size
+    """
+    cob = Cob()
+    report = []
+    for n_rows in sizes:
+        df = synthetic_input(n_rows)
+        _, loop_seconds = time_call(dataframe_to_dict_loop, df)
+        _, vectorised_seconds = time_call(cob.dataframe_to_dict, df)
+        _, compact_seconds = time_call(cob.dataframe_to_dict, df, compact=True)
+        report.append({'rows': n_rows,
+                       'itertuples_seconds': round(loop_seconds, 4),
+                       'groupby_seconds': round(vectorised_seconds, 4),
+                       'groupby_compact_seconds': round(compact_seconds, 4)})
+    return report
+
+
+# Sizes of the synthetic graph and input file for each scale of the pipeline benchmark
+SCALES = OrderedDict([
+    ('small', {'n_cobsystems': 5, 'n_parties': 10000, 'n_ucls': 2000, 'n_input': 2000}),
+    ('medium', {'n_cobsystems': 10, 'n_parties': 100000, 'n_ucls': 20000, 'n_input': 20000}),
+    ('large', {'n_cobsystems': 15, 'n_parties': 1000000, 'n_ucls': 200000, 'n_input': 200000}),
+])
+
+
+def synthetic_graph(n_cobsystems, n_parties, n_ucls, n_input, skew=1.2, max_fanout=200,
+                    unattached=0.1, seed=0):
+    """
+    Build a graph of Party and UCL nodes shaped like the client graph, and an input file
+    drawn from it. UCL sizes follow a power law, so a few UCLs have a large fan-out
+
+    :param n_cobsystems: number of Party labels, SYS0Party, SYS1Party, ...
+    :param n_parties: number of Party nodes
+    :param n_ucls: number of UCL nodes
+    :param n_input: number of rows in the input file, some of them not in the graph
+    :param skew: exponent of the power law, higher puts more Parties under the largest UCLs
+    :param max_fanout: roughly the most Parties any UCL has
+    :param unattached: fraction of Parties without a UCL
+    :param seed: random seed so repeated runs build the same graph
+    :return: tuple of (nodes, edges, input) DataFrames, nodes and edges in the form
+    UclIndex.build takes
+    """
+    rng = np.random.RandomState(seed)
+    systems = np.array(['SYS%d' % i for i in range(n_cobsystems)])
+    party_system = systems[rng.randint(0, n_cobsystems, n_parties)]
+    nodes = pd.DataFrame({'node': np.arange(n_parties),
+                          'labels': [['Party', system + 'Party'] for system in party_system],
+                          'node_id': np.char.add('P', np.arange(n_parties).astype(str))})
+
+    attached = np.flatnonzero(rng.random_sample(n_parties) >= unattached)
+    # every attached Party has a PRIMARY UCL, one in five a SECONDARY one as well
+    secondary = attached[rng.random_sample(len(attached)) < 0.2]
+    edge_node = np.concatenate([attached, secondary])
+    weights = 1.0 / np.arange(1, n_ucls + 1) ** skew
+    weights = np.minimum(weights / weights.sum(), float(max_fanout) / max(len(edge_node), 1))
+    edge_ucl = rng.choice(n_ucls, len(edge_node), p=weights / weights.sum())
+    edges = pd.DataFrame({'node': edge_node,
+                          'ucl': n_parties + edge_ucl,
+                          'ucl_id': np.char.add('U', edge_ucl.astype(str))})
+
+    # one in twenty input IDs is not in the graph
+    sample = rng.randint(0, n_parties, n_input)
+    missing = rng.random_sample(n_input) < 0.05
+    input_ids = np.where(missing, np.char.add('X', sample.astype(str)), nodes['node_id'].to_numpy()[sample])
+    df_input = pd.DataFrame({'COBSYSTEM': party_system[sample], 'COBSYSTEMID': input_ids})
+    return nodes, edges, df_input
+
+
+class FixtureBackend(QueryBackend):
+    """
+    Local stand-in for the graph, answering the queries the pipeline sends from a UclIndex
+    of a synthetic graph. Only the UCL lookup and the graph version queries are understood
+    """
+    name = 'fixture'
+
+    def __init__(self, ucl_index, latency=0.0):
+        """
+        :param latency: seconds added to each query, to mimic the round trip to a server
+        """
+        self.ucl_index = ucl_index
+        self.latency = latency
+        # number of IDs sent in UCL lookups
+        self.ids_queried = 0
+
+    def run(self, query, parameters=None):
+        time.sleep(self.latency)
+        match = re.search(r'MATCH \(input:(\w+)', query)
+        if match and parameters and 'ids' in parameters:
+            self.ids_queried += len(parameters['ids'])
+            df = self.ucl_index.resolve(match.group(1), parameters['ids'])
+            # the graph returns plain values, not categoricals
+            return df.astype(object).where(df.notnull(), None)
+        if 'GraphVersion' in query:
+            return pd.DataFrame({'buildDate': [self.ucl_index.graph_version], 'versionNumber': [1]})
+        raise NotImplementedError('The fixture graph does not understand the query: ' + query)
+
+
+def brute_force_hops(graph, cob, cobsystem_cobsystemid_dict, max_hops):
+    """
+    Reference for Cob.expand_hops: a separate breadth first search from every input, one
+    node at a time, keeping each (UCL, input, COB) row at the first hop it is found
+
+    :param graph: FixtureBackend
+    :param max_hops: number of hops, 0 until nothing new is found
+    :return: Pandas DataFrame with the UCL_COLUMNS columns and HOP_COLUMN
+    """
+    lookups = {}
+
+    def lookup(node):
+        if node not in lookups:
+            df = graph.run(cob.ucl_lookup_query(node[0]), {'ids': [node[1]]})
+            lookups[node] = list(df.reindex(columns=UCL_COLUMNS).itertuples(index=False, name=None))
+        return lookups[node]
+
+    found = OrderedDict()
+    for cobsystem, cobsystemid_list in cobsystem_cobsystemid_dict.items():
+        for cobsystemid in cobsystemid_list:
+            root = (cobsystem.upper() + 'Party', cobsystemid)
+            frontier = [root]
+            reached = set(frontier)
+            hop = 0
+            while frontier and (not max_hops or hop < max_hops):
+                hop += 1
+                next_frontier = []
+                for node in frontier:
+                    for ucl_id, _, _, node_id, node_party in lookup(node):
+                        # an input without a UCL is its own COB, only on the first hop
+                        if ucl_id is None and hop > 1:
+                            continue
+                        found.setdefault((ucl_id, root[1], root[0], node_id, node_party), hop)
+                        if node_id is not None and (node_party, node_id) not in reached:
+                            reached.add((node_party, node_id))
+                            next_frontier.append((node_party, node_id))
+                frontier = next_frontier
+    return pd.DataFrame([key + (hop,) for key, hop in found.items()], columns=UCL_COLUMNS + [HOP_COLUMN])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _measure_pipeline(scale, settings, queue):
+    from env import Env
+    stages = OrderedDict()
+
+    def stage(name, function, *args, **kwargs):
+        result, seconds = time_call(function, *args, **kwargs)
+        stages[name] = {'seconds': round(seconds, 4), 'peak_rss_mb': round(peak_rss_mb(), 1)}
+        return result
+
+    nodes, edges, df_input = synthetic_graph(**settings)
+    graph = FixtureBackend(stage('build_fixture_graph', UclIndex.build, nodes, edges, 'benchmark'))
+    directory = tempfile.mkdtemp()
+    try:
+        df_input.to_csv(os.path.join(directory, 'input.csv'), index=False)
+        env = Env(directory, 'configuration_settings.yaml', directory, 'input.csv')
+        env.graph = graph
+        cob = Cob(env)
+        cob.graph = graph
+
+        df = stage('load_input', cob.load_input)
+        di = stage('dataframe_to_dict', cob.dataframe_to_dict, df[INPUT_COLUMNS])
+        first = next(iter(di))
+        stage('py2neo_py2_and_py3', env.py2neo_py2_and_py3, graph,
+              cob.ucl_lookup_query(first.upper() + 'Party'), {'ids': di[first]})
+        result = stage('populate_cob', cob.populate_cob, di)
+    finally:
+        shutil.rmtree(directory)
+    queue.put(OrderedDict([('scale', scale), ('settings', settings), ('input_rows', len(df_input)),
+                           ('result_rows', len(result)), ('stages', stages)]))
+
+
+def pipeline_report(scales=('small', 'medium')):
+    """
+    Time each stage of the offboarding pipeline, load_input, dataframe_to_dict, a single
+    py2neo_py2_and_py3 lookup and populate_cob, against a synthetic graph at several scales.
+    Each scale runs in its own process so its peak memory is measured on its own
+
+    :param scales: names from SCALES
+    :return: dictionary ready to be saved as JSON
+    """
+    results = []
+    for scale in scales:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure_pipeline, args=(scale, SCALES[scale], queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    return OrderedDict([('commit', git_commit()),
+                        ('created', datetime.datetime.now().isoformat()),
+                        ('python', sys.version.split()[0]),
+                        ('pandas', pd.__version__),
+                        ('results', results)])
+
+
+# Graph of the hops benchmark, large enough for a few inputs to reach most of it in 3 hops
+HOPS_SETTINGS = {'n_cobsystems': 5, 'n_parties': 5000, 'n_ucls': 1000, 'n_input': 300}
+
+
+def _measure_hops(settings, max_hops, check, queue):
+    from env import Env
+    nodes, edges, df_input = synthetic_graph(**settings)
+    graph = FixtureBackend(UclIndex.build(nodes, edges, 'benchmark'))
+    env = Env(tempfile.gettempdir(), 'configuration_settings.yaml', '', '')
+    env.graph = graph
+    cob = Cob(env)
+    cob.graph = graph
+    cob.max_hops = max_hops
+    di = cob.dataframe_to_dict(df_input[INPUT_COLUMNS])
+    before = peak_rss_mb()
+    result, seconds = time_call(cob.populate_cob, di)
+    measured = OrderedDict([('max_hops', max_hops), ('input_rows', len(df_input)), ('result_rows', len(result)),
+                            ('ids_queried', graph.ids_queried), ('seconds', round(seconds, 4)),
+                            ('peak_rss_mb_before', round(before, 1)), ('peak_rss_mb_after', round(peak_rss_mb(), 1))])
+    if check:
+        reference = cob.combine_ucl_frames([brute_force_hops(graph, cob, di, max_hops)])
+        if max_hops == 1:
+            reference = reference.drop(columns=[HOP_COLUMN])
+        columns = list(result.columns)
+        measured['matches_reference'] = bool(
+            result.astype(str).sort_values(columns).reset_index(drop=True).equals(
+                reference[columns].astype(str).sort_values(columns).reset_index(drop=True)))
+    queue.put(measured)
+
+
+def hops_report(max_hops_list=(1, 2, 3), check=True, settings=None):
+    """
+    Time populate_cob with each number of UCL hops against a synthetic graph, counting the
+    IDs sent to the graph, and check the result against brute_force_hops. Each run is in
+    its own process so its peak memory is measured on its own
+
+    :param max_hops_list: values of Cob.max_hops to run, 0 until nothing new is found
+    :param check: compare each result with brute_force_hops, which is slow on large graphs
+    :param settings: arguments of synthetic_graph, HOPS_SETTINGS by default
+    :return: list of dictionaries, one per max_hops
+    """
+    report = []
+    for max_hops in max_hops_list:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure_hops,
+                                          args=(settings or HOPS_SETTINGS, max_hops, check, queue))
+        process.start()
+        report.append(queue.get())
+        process.join()
+    return report
+
+
+def compare_reports(old, new):
+    """
+    Compare two saved pipeline reports stage by stage
+
+    :param old: report of the baseline commit
+    :param new: report of the commit being checked
+    :return: list of dictionaries, one per scale and stage found in both
+    """
+    old_results = dict((result['scale'], result) for result in old['results'])
+    report = []
+    for result in new['results']:
+        if result['scale'] not in old_results:
+            continue
+        old_stages = old_results[result['scale']]['stages']
+        for name, timing in result['stages'].items():
+            if name not in old_stages:
+                continue
+            old_seconds = old_stages[name]['seconds']
+            report.append(OrderedDict([
+                ('scale', result['scale']), ('stage', name),
+                ('old_seconds', old_seconds), ('new_seconds', timing['seconds']),
+                ('ratio', round(timing['seconds'] / old_seconds, 2) if old_seconds else None),
+                ('old_peak_rss_mb', old_stages[name]['peak_rss_mb']),
+                ('new_peak_rss_mb', timing['peak_rss_mb'])]))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the offboarding pipeline')
+    commands = parser.add_subparsers(dest='command')
+    pipeline = commands.add_parser('pipeline', help='time every pipeline stage against a synthetic graph')
+    pipeline.add_argument('--scale', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+    pipeline.add_argument('--output', help='JSON file to save the results to, '
+                                           'benchmark_<commit>.json by default')
+    compare = commands.add_parser('compare', help='compare two saved pipeline results')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    memory = commands.add_parser('memory', help='peak memory of combining lookup results')
+    memory.add_argument('rows', nargs='?', type=int, default=1000000)
+    grouping = commands.add_parser('grouping', help='time dataframe_to_dict')
+    grouping.add_argument('rows', nargs='*', type=int, default=[10000, 100000, 1000000])
+    hops = commands.add_parser('hops', help='time and check multi-hop UCL expansion')
+    hops.add_argument('max_hops', nargs='*', type=int, default=[1, 2, 3])
+    hops.add_argument('--parties', type=int, default=HOPS_SETTINGS['n_parties'])
+    hops.add_argument('--ucls', type=int, default=HOPS_SETTINGS['n_ucls'])
+    hops.add_argument('--inputs', type=int, default=HOPS_SETTINGS['n_input'])
+    hops.add_argument('--no-check', action='store_true', help='skip the brute force reference')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.old) as old, open(args.new) as new:
+            report = compare_reports(json.load(old), json.load(new))
+    elif args.command == 'memory':
+        report = memory_report(args.rows)
+    elif args.command == 'grouping':
+        report = grouping_report(args.rows)
+    elif args.command == 'hops':
+        report = hops_report(args.max_hops, not args.no_check,
+                             dict(HOPS_SETTINGS, n_parties=args.parties, n_ucls=args.ucls, n_input=args.inputs))
+    elif args.command == 'pipeline':
+        results = pipeline_report(args.scale)
+        output = args.output or 'benchmark_' + results['commit'] + '.json'
+        with open(output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+        print('Saved the results to', output)
+        report = [OrderedDict([('scale', result['scale']), ('stage', name)] + list(timing.items()))
+                  for result in results['results'] for name, timing in result['stages'].items()]
+    else:
+        parser.print_help()
+        sys.exit(1)
+    print(pd.DataFrame(report).to_string(index=False))
@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+import json
+import time
+import sqlite3
+import threading
+import pandas as pd
+
+# Older SQLite builds refuse more than 999 variables in a single statement
+SQLITE_MAX_VARIABLES = 900
+
+
+class LookupCache():
+    """
+    On-disk SQLite cache of UCL lookup results. The result rows of each input COBSYSTEMID
+    are stored under (COBSYSTEM, COBSYSTEMID, graph version, filter signature), so a repeat
+    run against the same build of the graph only queries the IDs it hasn't seen before.
+    Rows filtered by an AccountSystemFilter are kept apart from unfiltered ones by the
+    signature, and both stay in the cache. Entries from any other graph version are deleted
+    when the cache is opened, and the least recently used IDs are evicted once the cache
+    holds more than max_ids of them
+    """
+
+    def __init__(self, file_path, graph_version, max_ids=1000000, filter_signature=''):
+        """
+        :param file_path: path of the SQLite database, created if it doesn't exist
+        :param graph_version: string identifying the build of the graph, see Env.graph_version
+        :param max_ids: maximum number of input IDs kept in the cache
+        :param filter_signature: AccountSystemFilter.signature of the filter the rows went
+        through, empty for unfiltered rows
+        """
+        self.file_path = file_path
+        self.graph_version = graph_version
+        self.filter_signature = filter_signature
+        self.max_ids = max_ids
+        # Cob looks up COBSYSTEMs from several threads, they share this connection
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        with self.lock, self.connection:
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(lookups)')]
+            if columns and 'filter_signature' not in columns:
+                # made by an older version, which keyed filtered rows on the graph version
+                self.connection.execute('DROP TABLE lookups')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS lookups (
+                    cobsystem TEXT NOT NULL,
+                    cobsystemid TEXT NOT NULL,
+                    graph_version TEXT NOT NULL,
+                    filter_signature TEXT NOT NULL,
+                    rows TEXT NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (cobsystem, cobsystemid, graph_version, filter_signature))''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS lookups_last_used ON lookups (last_used)')
+            # The graph has been rebuilt since these were stored, they can't be trusted
+            self.connection.execute('DELETE FROM lookups WHERE graph_version != ?', (graph_version,))
+
+    def get(self, cobsystem, cobsystemid_list, columns):
+        """
+        Split the IDs into those already in the cache and those which still need a query
+
+        :param cobsystem: node label of the input system, e.g. 'DBCATParty'
+        :param cobsystemid_list: list of COBSYSTEMIDs
+        :param columns: column names of the stored rows
+        :return: tuple of (DataFrame of cached rows, list of IDs missing from the cache)
+        """
+        found = {}
+        now = time.time()
+        with self.lock, self.connection:
+            for start in range(0, len(cobsystemid_list), SQLITE_MAX_VARIABLES):
+                ids = [str(cobsystemid) for cobsystemid in cobsystemid_list[start:start + SQLITE_MAX_VARIABLES]]
+                placeholders = ','.join('?' * len(ids))
+                cursor = self.connection.execute(
+                    'SELECT cobsystemid, rows FROM lookups WHERE cobsystem = ? AND graph_version = ? '
+                    'AND filter_signature = ? AND cobsystemid IN (' + placeholders + ')',
+                    [cobsystem, self.graph_version, self.filter_signature] + ids)
+                found.update(cursor.fetchall())
+                self.connection.execute(
+                    'UPDATE lookups SET last_used = ? WHERE cobsystem = ? AND graph_version = ? '
+                    'AND filter_signature = ? AND cobsystemid IN (' + placeholders + ')',
+                    [now, cobsystem, self.graph_version, self.filter_signature] + ids)
+        rows = [row for cobsystemid in found for row in json.loads(found[cobsystemid])]
+        missing = [cobsystemid for cobsystemid in cobsystemid_list if str(cobsystemid) not in found]
+        return pd.DataFrame(rows, columns=columns), missing
+
+    def put(self, cobsystem, cobsystemid_list, df):
+        """
+        Store the lookup result of the given IDs. An ID with no rows in df is stored too,
+        so an ID which isn't in the graph is not queried again
+
+        :param cobsystem: node label of the input system, e.g. 'DBCATParty'
+        :param cobsystemid_list: list of the COBSYSTEMIDs that were queried
+        :param df: DataFrame returned by the query, with an input_cobsystemid column
+        """
+        rows_by_id = dict((str(cobsystemid), []) for cobsystemid in cobsystemid_list)
+        # Missing values are stored as null rather than NaN, which is not valid JSON
+        values = df.astype(object).where(df.notnull(), None)
+        for row in values.itertuples(index=False):
+            rows_by_id.setdefault(str(row.input_cobsystemid), []).append(list(row))
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?, ?)',
+                [(cobsystem, cobsystemid, self.graph_version, self.filter_signature, json.dumps(rows), now)
+                 for cobsystemid, rows in rows_by_id.items()])
+            self.evict()
+
+    def evict(self):
+        # Called with the lock held, drops the least recently used IDs over max_ids
+        count = self.connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+        if count > self.max_ids:
+            self.connection.execute(
+                'DELETE FROM lookups WHERE rowid IN '
+                '(SELECT rowid FROM lookups ORDER BY last_used LIMIT ?)', (count - self.max_ids,))
+
+    def close(self):
+        self.connection.close()
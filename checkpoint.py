@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+import os
+import json
+import hashlib
+import logging
+import threading
+import pandas as pd
+from instrumentation import replace
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+try:
+    import pyarrow
+    SPILL_EXTENSION = '.parquet'
+except ImportError:
+    # Without pyarrow spills are pickled, which also keeps each column as one array
+    SPILL_EXTENSION = '.pkl'
+
+
+def unit_name(cobsystem, cobsystemid_list):
+    """
+    Name of a unit of work, one batch of IDs of one COBSYSTEM. The name is taken from the
+    IDs themselves, so the same batch gets the same name on every run
+
+    :return: string safe to use as a file name
+    """
+    digest = hashlib.md5('\n'.join(str(cobsystemid) for cobsystemid in cobsystemid_list)
+                         .encode('utf-8')).hexdigest()
+    return ''.join(c if c.isalnum() else '_' for c in cobsystem) + '-' + digest
+
+
+class Checkpoint():
+    """
+    Progress of a long run, kept on disk so it can be resumed. The lookup result of each
+    batch is spilled to its own file in the checkpoint directory, and a manifest lists the
+    finished batches with the number of rows in each. A run restarted after a failure
+    reads the finished batches back from their spill files and only queries the rest.
+    Spills from another graph version are thrown away when the checkpoint is opened.
+    Batches filtered by an AccountSystemFilter are recorded with its signature, so runs
+    with and without the filter each resume only from their own batches
+    """
+
+    def __init__(self, directory, graph_version='', filter_signature=''):
+        """
+        :param directory: directory holding the manifest and spill files, created if needed
+        :param graph_version: string identifying the build of the graph, see Env.graph_version
+        :param filter_signature: AccountSystemFilter.signature of the filter the results
+        went through, empty for unfiltered results
+        """
+        self.directory = directory
+        self.graph_version = graph_version
+        self.filter_signature = filter_signature
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # every unit in the manifest, whichever filter it was made with
+        self.units = {}
+        manifest = self.read_manifest()
+        if manifest.get('graph_version') == graph_version:
+            self.units = manifest.get('units', {})
+            done = sum(1 for entry in self.units.values() if entry.get('filter_signature', '') == filter_signature)
+            if done:
+                log.info('Resuming from %s, %d batches already done', directory, done)
+        elif manifest:
+            log.info('Discarding the checkpoint in %s, it was made against graph version %s',
+                     directory, manifest.get('graph_version'))
+            self.remove([], everything=True)
+
+    def key(self, unit):
+        # Name a unit is recorded and spilled under, the filtered and unfiltered results of
+        # the same batch are kept apart
+        return unit + '-' + self.filter_signature if self.filter_signature else unit
+
+    def read_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as manifest:
+            return json.load(manifest)
+
+    def write_manifest(self):
+        # Called with the lock held, the manifest is replaced in one rename so a crash
+        # never leaves it half written
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as manifest:
+            json.dump({'graph_version': self.graph_version, 'units': self.units}, manifest)
+        replace(path + '.tmp', path)
+
+    def is_done(self, unit):
+        return self.key(unit) in self.units
+
+    def spill(self, unit, df):
+        """
+        Write the result of a finished unit to its spill file and record it in the manifest
+
+        :param unit: name from unit_name
+        :param df: DataFrame with the lookup result of the unit
+        """
+        key = self.key(unit)
+        file_name = None
+        if len(df) and SPILL_EXTENSION == '.parquet':
+            file_name = key + SPILL_EXTENSION
+            path = os.path.join(self.directory, file_name)
+            try:
+                df.to_parquet(path + '.tmp', index=False)
+                replace(path + '.tmp', path)
+            except (TypeError, ValueError, pyarrow.ArrowException) as error:
+                # A column mixing types, e.g. ids stored as both numbers and text, has no
+                # Parquet type. The unit is pickled instead, keeping the values as they are
+                log.debug('Pickling %s, it cannot be written as Parquet: %r', key, error)
+                if os.path.exists(path + '.tmp'):
+                    os.remove(path + '.tmp')
+                file_name = None
+        if len(df) and file_name is None:
+            file_name = key + '.pkl'
+            path = os.path.join(self.directory, file_name)
+            df.to_pickle(path + '.tmp')
+            replace(path + '.tmp', path)
+        with self.lock:
+            self.units[key] = {'file': file_name, 'rows': len(df), 'filter_signature': self.filter_signature}
+            self.write_manifest()
+
+    def load(self, unit, columns):
+        """
+        Read the result of a finished unit back from its spill file
+
+        :param columns: column names, used for a unit which returned no rows
+        :return: Pandas DataFrame
+        """
+        file_name = self.units[self.key(unit)]['file']
+        if file_name is None:
+            return pd.DataFrame(columns=columns)
+        path = os.path.join(self.directory, file_name)
+        if file_name.endswith('.parquet'):
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def clear(self):
+        """
+        Delete the units made with this checkpoint's filter and their spill files, once the
+        run they belong to has finished. The manifest goes too when no other units are left
+        """
+        self.remove([key for key, entry in self.units.items()
+                     if entry.get('filter_signature', '') == self.filter_signature])
+
+    def remove(self, keys, everything=False):
+        # Drop the given units, or with everything set the manifest and every spill file
+        keys = set(keys)
+        with self.lock:
+            for key in keys:
+                self.units.pop(key, None)
+            for file_name in os.listdir(self.directory):
+                if file_name.endswith('.tmp') or (file_name.endswith(('.parquet', '.pkl')) and (
+                        everything or os.path.splitext(file_name)[0] in keys)):
+                    os.remove(os.path.join(self.directory, file_name))
+            if everything or not self.units:
+                self.units = {}
+                if os.path.exists(os.path.join(self.directory, MANIFEST)):
+                    os.remove(os.path.join(self.directory, MANIFEST))
+            else:
+                self.write_manifest()
@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+"""
+Command line entry point for offboarding runs, meant to be launched from a scheduler.
+
+    python cli.py config.yaml input.csv --output-directory out
+    python cli.py config.yaml offboarding_files "more/*.csv" --format parquet --max-workers 4
+    python cli.py config.yaml --validate
+    python cli.py config.yaml offboarding_files --dry-run
+    python cli.py config.yaml resubmitted.csv --prior out/original_output_2024_01_02_09_30.csv
+
+Every input is run in one session through batch.run_batch, so a single file and a
+directory of files are handled the same way. --help, --validate and --dry-run only read
+the configuration file and list the inputs: pandas, py2neo and the graph are not touched,
+so they return well within a second.
+
+The enrichment stages named by stages in the configuration file are run on the result of
+each input and written next to its output, see batch.write_stages. They need the whole
+result, so they can't be combined with --chunk-size.
+
+With --prior, a single input file is run incrementally against the output of an earlier
+run, see delta.py.
+
+Exit status: 0 on success, 1 if any COBSYSTEM lookup or enrichment stage failed, 2 for a
+bad configuration file or no input files.
+"""
+import os
+import sys
+import logging
+import argparse
+import datetime
+from config import load_config
+from output import OUTPUT_EXTENSIONS
+from instrumentation import instruments, configure_logging
+from batch import find_input_files, output_file_name
+
+log = logging.getLogger(__name__)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Offboard the COBSYSTEMIDs of one or more input files')
+    parser.add_argument('config', help='path of the YAML configuration file')
+    parser.add_argument('inputs', nargs='*', help='input files, directories or glob patterns')
+    parser.add_argument('-o', '--output-directory', default='.',
+                        help='directory the outputs are written to (default: the current directory)')
+    parser.add_argument('-f', '--format', choices=sorted(OUTPUT_EXTENSIONS),
+                        help='output format, overriding output_format in the configuration file')
+    parser.add_argument('--partition-by', help='write one output file per value of this column')
+    parser.add_argument('--max-workers', type=int, help='number of COBSYSTEMs looked up at the same time')
+    parser.add_argument('--batch-size', type=int, help='maximum number of IDs sent in one query')
+    parser.add_argument('--chunk-size', type=int, help='read results from the graph this many rows at a time')
+    parser.add_argument('--max-hops', type=int, help='UCL hops followed from each input, 0 until '
+                        'nothing new is found')
+    parser.add_argument('--log-level', help='overrides log_level in the configuration file')
+    parser.add_argument('--prior', help='output of an earlier run of the same input, only the '
+                        'IDs added since are looked up')
+    parser.add_argument('--prior-graph-version', help='graph version of the --prior output, read '
+                        'from the metadata saved with it by default')
+    parser.add_argument('--validate', action='store_true',
+                        help='check the configuration file and exit')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='check the configuration and list the inputs and outputs, without running')
+    return parser.parse_args(argv)
+
+
+def validate(config_path):
+    """
+    :return: tuple of (Config or None, error message or None)
+    """
+    try:
+        return load_config(config_path), None
+    except (IOError, OSError) as error:
+        return None, 'Cannot read ' + config_path + ': ' + str(error)
+    except ValueError as error:
+        return None, str(error)
+
+
+def dry_run(config, args, input_paths):
+    output_format = args.format or config.output_format
+    partition_by = args.partition_by or config.output_partition_by
+    timestamp = datetime.datetime.now().strftime("_%Y_%m_%d_%H_%M")
+    log.info('Graph %s over %s', config.redacted_graph_address(), config.backend)
+    for path in input_paths:
+        name = output_file_name(path, timestamp, '' if partition_by else OUTPUT_EXTENSIONS[output_format])
+        log.info('%s -> %s', path, os.path.join(args.output_directory, name))
+
+
+def run(config, args, input_paths):
+    """
+    Connect to the graph and offboard every input
+
+    :return: exit status
+    """
+    # Only a real run needs pandas and py2neo
+    from env import Env
+    from cob import Cob
+    from batch import run_batch
+    from delta import run_delta
+    yaml_directory, yaml_file = os.path.split(os.path.abspath(args.config))
+    env_class = Env(yaml_directory, yaml_file, '', '')
+    env_class.graph = env_class.connectToYamlGraph()
+    cob_class = Cob.from_config(env_class)
+    cob_class.graph = env_class.graph
+    for setting in ['max_workers', 'batch_size', 'chunk_size', 'max_hops']:
+        if getattr(args, setting) is not None:
+            setattr(cob_class, setting, getattr(args, setting))
+    output_options = dict(output_format=args.format or config.output_format,
+                          partition_by=args.partition_by or config.output_partition_by,
+                          compression=config.output_compression, stages=config.stages)
+    if args.prior:
+        run_delta(cob_class, input_paths[0], args.prior, args.output_directory,
+                  prior_graph_version=args.prior_graph_version, **output_options)
+    else:
+        run_batch(cob_class, input_paths, args.output_directory, **output_options)
+    if cob_class.failed_cobsystems or cob_class.failed_stages:
+        return 1
+    if cob_class.checkpoint is not None:
+        cob_class.checkpoint.clear()
+    return 0
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    config, error = validate(args.config)
+    configure_logging(args.log_level or (config.log_level if config else 'INFO'))
+    if error:
+        log.error(error)
+        return 2
+    if args.validate:
+        log.info('%s is valid', args.config)
+        return 0
+
+    input_paths = find_input_files(args.inputs)
+    if not input_paths:
+        log.error('No input files found in: %s', ', '.join(args.inputs) or 'no inputs given')
+        return 2
+    if args.chunk_size and config.stages:
+        log.error('--chunk-size streams the lookup result, it cannot be used with the stages '
+                  'in the configuration file: %s', ', '.join(config.stages))
+        return 2
+    if args.prior and len(input_paths) != 1:
+        log.error('--prior needs exactly one input file, got %d', len(input_paths))
+        return 2
+    if args.dry_run:
+        dry_run(config, args, input_paths)
+        return 0
+
+    instruments.configure(config)
+    return run(config, args, input_paths)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,62 +1,370 @@
 #! /usr/bin/env python
-import py2neo
 import os
-import yaml
+import re
+import logging
 import datetime
+import time
+import numpy as np
 import pandas as pd
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from env import Env
-class Cob():
+from cache import LookupCache
+from ucl_index import UclIndex, ranges
+from checkpoint import Checkpoint, unit_name
+from output import OutputWriter, OUTPUT_EXTENSIONS
+from pipeline import Pipeline
+from system_filter import AccountSystemFilter
+from postprocess import PostProcessor
+from instrumentation import instruments, configure_logging
+
+log = logging.getLogger(__name__)
+
+# Columns returned by the UCL lookup, in the order populate_cob expects them
+UCL_COLUMNS = ['UCL_ID', 'input_cobsystemid', 'input_cobsystem', 'COBSYSTEMID', 'COBSYSTEM']
+# Columns read from the input file
+INPUT_COLUMNS = ['COBSYSTEM', 'COBSYSTEMID']
+# Columns holding node labels, these have very few distinct values
+LABEL_COLUMNS = ['input_cobsystem', 'COBSYSTEM']
+# Column added by expand_hops, the number of UCLs crossed to reach the COB of the row
+HOP_COLUMN = 'HOP'
+
+
+def column_tuples(df, columns):
+    # the rows of some columns as tuples, each column is converted to a list in one go as
+    # iterating over a Series value by value is slow
+    return zip(*[df[column].tolist() for column in columns])
+
 
+class HopGraph():
+    """
+    The part of the graph Cob.expand_hops has looked up so far: the UCLs of each node
+    queried, and the COBs under each UCL. Each lookup result is kept as it came, with the
+    rows of the UCLs it found first grouped together and indexed by position, so nothing
+    gathered in earlier hops is copied again
+    """
 
     def __init__(self):
+        # (label, id) of each node queried to the UCL_IDs next to it
+        self.node_ucls = {}
+        # DataFrames of UCL_ID, COBSYSTEMID and COBSYSTEM, and for each UCL_ID the
+        # (frame, start, stop) of its rows
+        self.frames = []
+        self.ucl_rows = {}
+
+    def add(self, df, queried):
+        """
+        :param df: lookup result with the UCL_COLUMNS columns
+        :param queried: (label, id) of the nodes looked up, a node with no rows has no UCL
+        """
+        for node in queried:
+            self.node_ucls.setdefault(node, [])
+        edges = df.loc[df['UCL_ID'].notnull(), ['input_cobsystem', 'input_cobsystemid', 'UCL_ID']]
+        for cobsystem_party, cobsystemid, ucl_id in column_tuples(edges.drop_duplicates(), edges.columns):
+            self.node_ucls.setdefault((cobsystem_party, cobsystemid), []).append(ucl_id)
+
+        # any lookup crossing a UCL returns every COB under it, the first one is kept
+        members = df.loc[df['UCL_ID'].notnull(), ['UCL_ID', 'COBSYSTEMID', 'COBSYSTEM']]
+        members = members[[ucl_id not in self.ucl_rows for ucl_id in members['UCL_ID'].tolist()]].drop_duplicates()
+        if not len(members):
+            return
+        codes, ucl_ids = pd.factorize(members['UCL_ID'])
+        members = members.iloc[np.argsort(codes, kind='stable')].reset_index(drop=True)
+        stops = np.cumsum(np.bincount(codes, minlength=len(ucl_ids)))
+        for ucl_id, start, stop in zip(ucl_ids, stops - np.bincount(codes, minlength=len(ucl_ids)), stops):
+            self.ucl_rows[ucl_id] = (len(self.frames), start, stop)
+        self.frames.append(members)
+
+    def rows(self, pairs):
+        """
+        :param pairs: list of (input label, input id, UCL_ID)
+        :return: DataFrame with the UCL_COLUMNS columns, a row for each pair and COB under
+        its UCL
+        """
+        by_frame = defaultdict(list)
+        for pair in pairs:
+            frame, start, stop = self.ucl_rows[pair[2]]
+            by_frame[frame].append((pair[0], pair[1], start, stop - start))
+        df_list = []
+        for frame, items in by_frame.items():
+            labels, ids, starts, counts = [np.array(values, dtype=dtype) for values, dtype
+                                           in zip(zip(*items), [object, object, np.int64, np.int64])]
+            members = self.frames[frame].iloc[ranges(starts, counts)]
+            df_list.append(pd.DataFrame({'UCL_ID': members['UCL_ID'].to_numpy(),
+                                         'input_cobsystemid': np.repeat(ids, counts),
+                                         'input_cobsystem': np.repeat(labels, counts),
+                                         'COBSYSTEMID': members['COBSYSTEMID'].to_numpy(),
+                                         'COBSYSTEM': members['COBSYSTEM'].to_numpy()}, columns=UCL_COLUMNS))
+        return pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame(columns=UCL_COLUMNS)
+
+
+class Cob():
+
+
+    def __init__(self, env=None, batch_size=10000, max_workers=1, chunk_size=None):
         """self.yaml_directory = yaml_directory
         self.yaml_file = yaml_file
         self.offboard_directory = offboard_directory
         self.offboard_file = offboard_file
         self.yaml_path_file = os.path.join(yaml_directory, yaml_file)
         self.offboard_path_file = os.path.join(offboard_directory, offboard_file)"""
+        # The Env instance holds the file locations and knows how to run queries
+        self.env = env
+        # Maximum number of COBSYSTEMIDs sent to the graph in a single query
+        self.batch_size = batch_size
+        # Number of COBSYSTEMs queried at the same time, 1 runs them one after another
+        self.max_workers = max_workers
+        # When set, results are read from the graph in chunks of this many rows
+        self.chunk_size = chunk_size
+        # Optional LookupCache, IDs found in it are not sent to the graph
+        self.cache = None
+        # Optional UclIndex, when set lookups are resolved from it instead of the graph
+        self.ucl_index = None
+        # Optional Checkpoint, batches already spilled by an earlier run are read back from it
+        self.checkpoint = None
+        # Seconds taken by, and errors raised by, the last lookup of each COBSYSTEM
+        self.query_timings = OrderedDict()
+        self.failed_cobsystems = OrderedDict()
+        # Enrichment stages which failed in the last run, per input path, see batch.write_stages
+        self.failed_stages = OrderedDict()
         self.account_system_filters = ['M_TRADE', 'BR', 'CMTS', 'DABBLE', 'DB CAT', 'DBA',
                                   'DCM', 'DOMS', 'GB_SWAP', 'GES',
                                   'Global financial calculator', 'IDEAL', 'JP_SWAP',
                                   'MIS', 'MX', 'RCS', 'STR_M_TRADE', 'US_SWAP', 'XFI']
+        # Optional AccountSystemFilter, when set its systems are left out of the results
+        self.system_filter = None
+        # Build of the graph the results come from, see Env.graph_version, set by from_config
+        self.graph_version = None
+        # Number of UCL hops followed from each input, 0 follows them until nothing new is
+        # found. 1 is the single input -> UCL -> COB lookup, see expand_hops
+        self.max_hops = 1
+        # Renames the labels and drops repeated rows of the combined result, see postprocess.py
+        self.postprocessor = PostProcessor()
+
+    @classmethod
+    def from_config(cls, env):
+        """
+        Create a Cob using the batch_size, max_workers and chunk_size settings from the
+        configuration file of env. When the file has a ucl_index_directory, lookups are
+        resolved offline from a UclIndex of the current graph version, otherwise when it has
+        a cache_path they go through a LookupCache. A checkpoint_directory makes the run
+        resumable, see Checkpoint. All of these need env to be connected already. With
+        exclude_account_systems set, account_system_filters are left out of the results
+
+        :param env: Env
+        :return: Cob
+        """
+        config = env.config
+        cob = cls(env, batch_size=config.batch_size, max_workers=config.max_workers,
+                  chunk_size=config.chunk_size)
+        cob.max_hops = config.max_hops
+        cob.postprocessor = PostProcessor(config.label_map, config.postprocess_workers)
+        if config.exclude_account_systems:
+            cob.system_filter = AccountSystemFilter(cob.account_system_filters)
+        cob.graph_version = graph_version = env.graph_version()
+        # cached and spilled results were filtered, they only match runs with the same filter
+        filter_signature = '' if cob.system_filter is None else cob.system_filter.signature()
+        if config.ucl_index_directory:
+            cob.ucl_index = UclIndex.for_version(env, env.graph, config.ucl_index_directory,
+                                                 graph_version)
+        elif config.cache_path:
+            cob.cache = LookupCache(config.cache_path, graph_version, config.cache_max_ids, filter_signature)
+        if config.checkpoint_directory and cob.ucl_index is None:
+            cob.checkpoint = Checkpoint(config.checkpoint_directory, graph_version, filter_signature)
+        return cob
+
+    def result_settings(self):
+        """
+        The settings besides the graph version which change the rows of a result, saved with
+        each output so an incremental run only carries over rows built the same way, see
+        delta.py
 
-    def dataframe_to_dict(self,df):
-        #takes multicolumn dataframe and returns dictionary
+        :return: OrderedDict of setting name to JSON serialisable value
+        """
+        return OrderedDict([('max_hops', self.max_hops),
+                            ('filter_signature', '' if self.system_filter is None else self.system_filter.signature()),
+                            ('label_map', self.postprocessor.label_map)])
+
+    def normalize_ids(self, series):
+        """
+        Convert COBSYSTEMIDs to stripped strings, the type the ids are stored with in the
+        graph. A numeric column read with missing values is float, so whole numbers are
+        turned back into integers first, giving '123' rather than '123.0'. Each value is
+        converted on its own, so a fractional ID doesn't change how the others are written
+
+        :param series: Pandas Series of COBSYSTEMIDs
+        :return: Pandas Series of strings
+        """
+        if pd.api.types.is_numeric_dtype(series):
+            text = series.astype(str)
+            if pd.api.types.is_float_dtype(series):
+                whole = ((series % 1 == 0) & (series.abs() < 2 ** 63)).to_numpy()
+                text[whole] = series[whole].astype(np.int64).astype(str)
+            return text
+        # only text read from the file can carry stray whitespace
+        return series.astype(str).str.strip()
+
+    @instruments.timed('dataframe_to_dict')
+    def dataframe_to_dict(self, df, compact=False):
+        """
+        Group the COBSYSTEMIDs of the input by COBSYSTEM, in one vectorised pass rather than
+        a python loop over every row. Missing and repeated IDs are dropped
+
+        :param df: DataFrame whose first column is COBSYSTEM and second is COBSYSTEMID
+        :param compact: return NumPy unicode arrays of IDs instead of lists of strings
+        :return: dictionary of COBSYSTEM to IDs, in the order the systems first appear
+        """
+        df = df.iloc[:, :2].dropna()
+        # Work on integer codes: number each system and each distinct raw ID, so only the
+        # distinct IDs are converted to strings, not every row
+        key_codes, keys = pd.factorize(df.iloc[:, 0])
+        raw_codes, raw_ids = pd.factorize(df.iloc[:, 1])
+        # normalising can make two raw IDs equal, e.g. 7 and 7.0, so number them again
+        id_codes, ids = pd.factorize(self.normalize_ids(pd.Series(raw_ids)))
+        id_codes = id_codes[raw_codes]
+        # one integer per (system, ID) pair, pd.unique keeps the first of each in order
+        pairs = pd.unique(key_codes.astype(np.int64) * max(len(ids), 1) + id_codes)
+        key_codes, id_codes = np.divmod(pairs, max(len(ids), 1))
+        # a stable sort on the system code puts each system's IDs next to each other
+        # without reordering them
+        order = np.argsort(key_codes, kind='stable')
+        groups = np.split(np.asarray(ids, dtype=object)[id_codes[order]],
+                          np.cumsum(np.bincount(key_codes, minlength=len(keys)))[:-1])
         mydict = defaultdict(list)
-        for (key, val) in df.itertuples(index=False):
-            # the str(val) conversion is specifically to create a cypher readable list
-            mydict[key].append(str(val))
+        for key, ids in zip(keys, groups):
+            # astype(str) packs the IDs into one fixed width unicode array
+            mydict[key] = ids.astype(str) if compact else ids.tolist()
         return mydict
 
-    def load_input(self):
+    def iter_input(self, chunksize=None, path=None):
+        """
+        Read the COBSYSTEM and COBSYSTEMID columns of the input file, and nothing else. The
+        IDs are read as text, exactly as written, rather than letting pandas guess a type.
+        Parquet and Feather files are read by their extension, anything else as CSV
+
+        :param chunksize: when set, read the file this many rows at a time
+        :param path: file to read instead of the input file of self.env
+        :return: generator of Pandas DataFrames
+        """
+        path = path or self.env.offboard_path_file
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.parquet':
+            if chunksize:
+                import pyarrow.parquet as pq
+                for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=INPUT_COLUMNS):
+                    yield batch.to_pandas()
+            else:
+                yield pd.read_parquet(path, columns=INPUT_COLUMNS)
+        elif extension == '.feather':
+            yield pd.read_feather(path, columns=INPUT_COLUMNS)
+        else:
+            df_input = pd.read_csv(path, usecols=INPUT_COLUMNS, chunksize=chunksize,
+                                   dtype={'COBSYSTEM': 'category', 'COBSYSTEMID': str})
+            if chunksize:
+                for df in df_input:
+                    yield df
+            else:
+                yield df_input
+
+    def summarise_input(self, df_input):
+        log.info('Successfully found off-boarding input file %s with %d rows\n%s',
+                 self.env.offboard_file, len(df_input), df_input.describe().T)
+
+    @instruments.timed('load_input')
+    def load_input(self, chunksize=None, verbose=False):
         #TODO: Move to another class?
-        #TODO: Remove all of these largely unnecessary print lines!
-        print('Successfully found off-boarding input file:')
-        print(self.offboard_file)
-        print()
-
-        print('The name of the input file supplied by Bonnie and Phil is:')
-        print(self.offboard_file)
-        print()
-        df_input = pd.read_csv(self.offboard_path_file)
-        #TODO: load df_input into dictionary
-        print('The contents of the input file supplied by Bonnie and Phil:')
-        print(df_input)
-
-        # Offer some information on the output
-        print('')
-        print(df_input.describe().T)
+        """
+        Load the whole input file into one DataFrame
+
+        :param chunksize: read the file this many rows at a time, see iter_input
+        :param verbose: log a summary of the input
+        :return: Pandas DataFrame with the COBSYSTEM and COBSYSTEMID columns
+        """
+        df_list = list(self.iter_input(chunksize))
+        df_input = df_list[0] if len(df_list) == 1 else pd.concat(df_list, ignore_index=True)
+        if verbose:
+            self.summarise_input(df_input)
         return df_input
 
-    def input_cob_get_ucl_and_ucl_children(self, cobsystem, cobsystemid_list):
-        # TODO: Move to another class?
-        #TODO: graph argument shouldn't be here. The graph should be global once created.
-        cobsystem_party = cobsystem.upper() + 'Party'
-        print(cobsystem_party, cobsystemid_list)
-        query = '''
-        MATCH (input:''' + cobsystem_party + ''') where input.id in ''' + cobsystemid_list + '''
-        and (input)-[:PRIMARY|SECONDARY]-(:UCL)
+    @instruments.timed('load_input_grouped')
+    def load_input_grouped(self, chunksize=100000, verbose=False, path=None):
+        """
+        Read the input file in chunks and group each chunk straight away with
+        dataframe_to_dict, so the whole file is never held in memory as a DataFrame
+
+        :param chunksize: number of rows read at a time
+        :param verbose: log how many IDs were found for each COBSYSTEM
+        :param path: file to read instead of the input file of self.env
+        :return: dictionary of COBSYSTEM to list of unique COBSYSTEMIDs
+        """
+        grouped = OrderedDict()
+        for df in self.iter_input(chunksize, path):
+            for key, ids in self.dataframe_to_dict(df[INPUT_COLUMNS]).items():
+                grouped.setdefault(key, OrderedDict()).update(OrderedDict.fromkeys(ids))
+        mydict = defaultdict(list)
+        for key, ids in grouped.items():
+            mydict[key] = list(ids)
+            if verbose:
+                log.info('%s %d IDs', key, len(ids))
+        return mydict
+
+    def ucl_lookup_query(self, cobsystem_party, exclude=False):
+        """
+        Build the UCL lookup query for a single COBSYSTEM label. The IDs are not part
+        of the query text, they are passed in as the $ids parameter, so the text is the
+        same for every call against the same label and Neo4j reuses the cached plan.
+
+        Each input node is found once. An input without a UCL comes out of the OPTIONAL
+        MATCH with u as null, and the CASE expressions then return the input itself as
+        its COB, as the second branch of legacy_ucl_lookup_query did
+
+        :param cobsystem_party: node label of the input system, e.g. 'DBCATParty'
+        :param exclude: drop the rows whose COBSYSTEM is in the $excluded parameter, see
+        AccountSystemFilter
+        :return: cypher query string
+        """
+        if not exclude:
+            return '''
+        UNWIND $ids AS id
+        MATCH (input:''' + cobsystem_party + ''' {id: id})
+        OPTIONAL MATCH (input)-[:PRIMARY|SECONDARY]-(u:UCL)
+        OPTIONAL MATCH (u)-[:PRIMARY|SECONDARY]-(cob)
+        RETURN DISTINCT
+        u.id as UCL_ID,
+        input.id as input_cobsystemid,
+        labels(input)[1] as input_cobsystem,
+        CASE WHEN u IS NULL THEN input.id ELSE cob.id END as COBSYSTEMID,
+        CASE WHEN u IS NULL THEN labels(input)[1] ELSE labels(cob)[1] END as COBSYSTEM
+        '''
+        # the same rows with the excluded systems filtered out before they are returned
+        return '''
+        UNWIND $ids AS id
+        MATCH (input:''' + cobsystem_party + ''' {id: id})
+        OPTIONAL MATCH (input)-[:PRIMARY|SECONDARY]-(u:UCL)
+        OPTIONAL MATCH (u)-[:PRIMARY|SECONDARY]-(cob)
+        WITH u, input, CASE WHEN u IS NULL THEN input ELSE cob END as node
+        WHERE NOT coalesce(labels(node)[1], '') IN $excluded
+        RETURN DISTINCT
+        u.id as UCL_ID,
+        input.id as input_cobsystemid,
+        labels(input)[1] as input_cobsystem,
+        node.id as COBSYSTEMID,
+        labels(node)[1] as COBSYSTEM
+        '''
+
+    def legacy_ucl_lookup_query(self, cobsystem_party):
+        """
+        The UNION form of the UCL lookup, which finds the input nodes twice, once for those
+        with a UCL and once for those without. Only kept so query_check.py can compare its
+        results and cost with ucl_lookup_query
+
+        :param cobsystem_party: node label of the input system, e.g. 'DBCATParty'
+        :return: cypher query string
+        """
+        return '''
+        UNWIND $ids AS id
+        MATCH (input:''' + cobsystem_party + ''' {id: id})
+        where (input)-[:PRIMARY|SECONDARY]-(:UCL)
         with input
         OPTIONAL MATCH (input)-[:PRIMARY|SECONDARY]-(u:UCL)
         with u, input.id as input_cobsystemid, labels(input)[1] as input_cobsystem
@@ -70,8 +378,9 @@ class Cob():
 
         union
 
-        MATCH (input:''' + cobsystem_party + ''') where input.id in ''' + cobsystemid_list + '''
-        and not (input)-[:PRIMARY|SECONDARY]-(:UCL)
+        UNWIND $ids AS id
+        MATCH (input:''' + cobsystem_party + ''' {id: id})
+        where not (input)-[:PRIMARY|SECONDARY]-(:UCL)
         with input
         OPTIONAL MATCH (input)-[:PRIMARY|SECONDARY]-(u:UCL)
         with u, input.id as input_cobsystemid, labels(input)[1] as input_cobsystem
@@ -83,29 +392,318 @@ class Cob():
         input_cobsystem as COBSYSTEM
         '''
 
-        df = self.py2neo_py2_and_py3(self.graph, query)
-        # print(df_result)
+    def batches(self, cobsystemid_list):
+        """
+        Split a list of COBSYSTEMIDs into chunks of at most self.batch_size, dropping
+        repeated IDs so the same ID is never sent to the graph twice
+
+        :param cobsystemid_list: list of COBSYSTEMIDs
+        :return: generator of lists
+        """
+        unique_ids = list(OrderedDict.fromkeys(cobsystemid_list))
+        for start in range(0, len(unique_ids), self.batch_size):
+            yield unique_ids[start:start + self.batch_size]
+
+    def check_id_indexes(self, cobsystems):
+        """
+        Check that the id property of each input label is indexed. Without an index the
+        lookup scans every node with the label for each ID
+
+        :param cobsystems: iterable of COBSYSTEM names, e.g. the keys of the input dictionary
+        :return: dictionary of node label to True if an index on its id property exists
+        """
+        df = self.env.py2neo_py2_and_py3(self.graph, 'CALL db.indexes()')
+        indexed = set()
+        for row in df.to_dict('records'):
+            # Neo4j 4 lists labelsOrTypes, 3.5 tokenNames, earlier versions only describe
+            # the index as 'INDEX ON :Label(property)'
+            labels = row.get('labelsOrTypes') or row.get('tokenNames')
+            properties = row.get('properties')
+            if labels is None or properties is None:
+                match = re.search(r':(\w+)\((\w+)\)', str(row.get('description', '')))
+                labels, properties = ([match.group(1)], [match.group(2)]) if match else ([], [])
+            # a composite index can't serve a lookup on id alone
+            if list(properties) == ['id']:
+                indexed.update(labels)
+        result = OrderedDict()
+        for cobsystem in cobsystems:
+            cobsystem_party = cobsystem.upper() + 'Party'
+            result[cobsystem_party] = cobsystem_party in indexed
+            if not result[cobsystem_party]:
+                log.warning('There is no index on %s.id', cobsystem_party)
+        return result
+
+    def iter_ucl_and_ucl_children(self, cobsystem, cobsystemid_list):
+        """
+        Run the UCL lookup for one COBSYSTEM, yielding the result one DataFrame at a time.
+        There is one DataFrame per batch of IDs, or, when self.chunk_size is set, the
+        result of each batch is read from the graph in chunks of that many rows. With
+        self.ucl_index set the whole lookup is answered offline in a single DataFrame.
+        With self.checkpoint set, each batch is spilled once it is complete, and a batch
+        spilled by an earlier run is read back instead of being queried again. With
+        self.system_filter set, the excluded systems are filtered out by the query and any
+        left over are masked out of each DataFrame
+
+        :param cobsystem: name of the input system, e.g. 'DBCAT'
+        :param cobsystemid_list: list of COBSYSTEMIDs
+        :return: generator of Pandas DataFrames
+        """
+        return self.iter_label_ucl_and_ucl_children(cobsystem.upper() + 'Party', cobsystemid_list)
+
+    def iter_label_ucl_and_ucl_children(self, cobsystem_party, cobsystemid_list):
+        # iter_ucl_and_ucl_children for a node label, as found in the COBSYSTEM column
+        if self.system_filter is None:
+            for df in self.iter_unfiltered_ucl_and_ucl_children(cobsystem_party, cobsystemid_list):
+                yield df
+            return
+        for df in self.iter_unfiltered_ucl_and_ucl_children(cobsystem_party, cobsystemid_list):
+            yield self.system_filter.apply(df)
+
+    def iter_unfiltered_ucl_and_ucl_children(self, cobsystem_party, cobsystemid_list):
+        # iter_label_ucl_and_ucl_children before the remaining excluded rows are masked out
+        if self.ucl_index is not None:
+            yield self.ucl_index.resolve(cobsystem_party, cobsystemid_list)
+            return
+        query = self.ucl_lookup_query(cobsystem_party, exclude=self.system_filter is not None)
+        excluded = {} if self.system_filter is None else {'excluded': self.system_filter.labels}
+        if self.cache is not None:
+            unique_ids = list(OrderedDict.fromkeys(cobsystemid_list))
+            df_cached, cobsystemid_list = self.cache.get(cobsystem_party, unique_ids, UCL_COLUMNS)
+            log.info('%s %d rows from the cache', cobsystem_party, len(df_cached))
+            if len(df_cached):
+                yield df_cached
+        for batch in self.batches(cobsystemid_list):
+            if self.checkpoint is not None:
+                unit = unit_name(cobsystem_party, batch)
+                if self.checkpoint.is_done(unit):
+                    log.debug('%s batch of %d IDs read from the checkpoint', cobsystem_party, len(batch))
+                    yield self.checkpoint.load(unit, UCL_COLUMNS)
+                    continue
+            log.debug('%s batch of %d IDs', cobsystem_party, len(batch))
+            parameters = dict(excluded, ids=batch)
+            if self.chunk_size:
+                df_list = self.env.py2neo_stream(self.graph, query, parameters, self.chunk_size)
+            else:
+                df_list = [self.env.py2neo_py2_and_py3(self.graph, query, parameters)]
+            if self.cache is not None or self.checkpoint is not None:
+                # the whole batch is needed to store every ID's rows together
+                df_list = list(df_list)
+                df_batch = pd.concat(df_list).reindex(columns=UCL_COLUMNS) if df_list \
+                    else pd.DataFrame(columns=UCL_COLUMNS)
+                if self.cache is not None:
+                    self.cache.put(cobsystem_party, batch, df_batch)
+                if self.checkpoint is not None:
+                    self.checkpoint.spill(unit, df_batch)
+            for df in df_list:
+                yield df
+
+    def input_cob_get_ucl_and_ucl_children(self, cobsystem, cobsystemid_list):
+        # TODO: Move to another class?
+        """
+        Return the UCL parents of the input COBSYSTEMIDs and every COB under those UCLs.
+        The IDs are sent as a query parameter in batches of self.batch_size, so the query
+        text stays small and identical between calls
+
+        :param cobsystem: name of the input system, e.g. 'DBCAT'
+        :param cobsystemid_list: list of COBSYSTEMIDs
+        :return: Pandas DataFrame with the UCL_COLUMNS columns
+        """
+        with instruments.timer('input_cob_get_ucl_and_ucl_children', cobsystem=cobsystem) as fields:
+            df_list = list(self.iter_ucl_and_ucl_children(cobsystem, cobsystemid_list))
+            if not df_list:
+                df = pd.DataFrame(columns=UCL_COLUMNS)
+            else:
+                # reindex guarantees the columns exist even when the graph returned no rows
+                df = pd.concat(df_list, ignore_index=True).reindex(columns=UCL_COLUMNS)
+            fields['ids'] = len(cobsystemid_list)
+            fields['rows'] = len(df)
         return df
 
+    def timed_lookup(self, cobsystem, cobsystemid_list):
+        """
+        Run input_cob_get_ucl_and_ucl_children for one COBSYSTEM and time it
+
+        :return: tuple of (cobsystem, DataFrame, seconds taken)
+        """
+        start = time.time()
+        df = self.input_cob_get_ucl_and_ucl_children(cobsystem, cobsystemid_list)
+        return cobsystem, df, time.time() - start
+
+    def lookup_cobsystems(self, cobsystem_cobsystemid_dict):
+        """
+        Run the UCL lookup for every COBSYSTEM in the dictionary. With max_workers above 1
+        the lookups are sent to the graph at the same time from a thread pool, as the
+        queries for different systems don't depend on each other. A COBSYSTEM whose lookup
+        raises is recorded in self.failed_cobsystems and left out of the result, the other
+        systems carry on
+
+        :param cobsystem_cobsystemid_dict: dictionary of COBSYSTEM to list of COBSYSTEMIDs
+        :return: OrderedDict of COBSYSTEM to DataFrame, in the order of the input dictionary
+        """
+        self.query_timings = OrderedDict()
+        self.failed_cobsystems = OrderedDict()
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = {executor.submit(self.timed_lookup, cobsystem, cobsystemid_list): cobsystem
+                       for cobsystem, cobsystemid_list in cobsystem_cobsystemid_dict.items()}
+            for future in as_completed(futures):
+                cobsystem = futures[future]
+                try:
+                    cobsystem, df, seconds = future.result()
+                except Exception as error:
+                    log.error('FAILED to look up %s: %r', cobsystem, error)
+                    self.failed_cobsystems[cobsystem] = error
+                    continue
+                self.query_timings[cobsystem] = seconds
+                results[cobsystem] = df
+                log.info('%s %s %.2fs', cobsystem, df.shape, seconds)
+        return OrderedDict((cobsystem, results[cobsystem]) for cobsystem in cobsystem_cobsystemid_dict
+                           if cobsystem in results)
+
+    def expand_hops(self, df_list, max_hops=None):
+        """
+        Follow the UCLs of the COBs found by the lookup breadth first, so a client linked to
+        an input through a second UCL is found as well: input -> UCL -> COB -> UCL -> COB.
+        Every node is sent to the graph at most once, whichever input reaches it and however
+        many times, so each hop only queries the nodes it discovered. The nodes of a hop are
+        looked up one label at a time through iter_label_ucl_and_ucl_children, in batches
+        and through the cache and checkpoint like the first hop.
+
+        When an input first crosses a UCL every COB under it is found, so only the UCLs an
+        input hasn't crossed yet are expanded, and each hop only builds the rows it adds.
+        Rows keep the input they were reached from, and HOP_COLUMN holds the hop each row
+        was first found at
+
+        :param df_list: iterable of DataFrames with the UCL_COLUMNS columns, the first hop as
+        returned by lookup_cobsystems
+        :param max_hops: number of hops to stop at, self.max_hops by default, 0 to carry on
+        until a hop finds nothing new
+        :return: list of DataFrames with the UCL_COLUMNS columns and HOP_COLUMN, one per hop
+        """
+        max_hops = self.max_hops if max_hops is None else max_hops
+        roots = ['input_cobsystem', 'input_cobsystemid']
+        nodes = ['COBSYSTEM', 'COBSYSTEMID']
+        df_list = [df.reindex(columns=UCL_COLUMNS) for df in df_list]
+        df = pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame(columns=UCL_COLUMNS)
+        for column in LABEL_COLUMNS:
+            df[column] = df[column].astype(object)
+        df[HOP_COLUMN] = 1
+        found = [df]
+        graph = HopGraph()
+        graph.add(df, column_tuples(df, roots))
+        # (input, UCL) pairs crossed, and (input, node) pairs reached, so far
+        crossed = set(column_tuples(df, roots + ['UCL_ID']))
+        reached = set(column_tuples(df, roots + nodes))
+        frontier = df.loc[df['COBSYSTEMID'].notnull(), roots + nodes].drop_duplicates()
+        hop = 1
+        while len(frontier) and (not max_hops or hop < max_hops):
+            hop += 1
+            with instruments.timer('expand_hops', hop=str(hop)) as fields:
+                new_nodes = [node for node in OrderedDict.fromkeys(column_tuples(frontier, nodes))
+                             if node not in graph.node_ucls]
+                by_label = OrderedDict()
+                for cobsystem_party, cobsystemid in new_nodes:
+                    by_label.setdefault(cobsystem_party, []).append(cobsystemid)
+                df_new = [df_nodes for cobsystem_party, ids in by_label.items()
+                          for df_nodes in self.iter_label_ucl_and_ucl_children(cobsystem_party, ids)]
+                graph.add(pd.concat(df_new, ignore_index=True).reindex(columns=UCL_COLUMNS) if df_new
+                          else pd.DataFrame(columns=UCL_COLUMNS), new_nodes)
+
+                # the UCLs of the frontier nodes each input hasn't crossed yet
+                pairs = []
+                for root_party, root_id, cobsystem_party, cobsystemid in column_tuples(frontier, roots + nodes):
+                    for ucl_id in graph.node_ucls[(cobsystem_party, cobsystemid)]:
+                        pair = (root_party, root_id, ucl_id)
+                        if pair not in crossed:
+                            crossed.add(pair)
+                            pairs.append(pair)
+                df = graph.rows(pairs)
+                df[HOP_COLUMN] = hop
+                found.append(df)
+
+                # only the nodes an input reached for the first time are followed further
+                first = np.zeros(len(df), dtype=bool)
+                for position, key in enumerate(column_tuples(df, roots + nodes)):
+                    if key not in reached:
+                        reached.add(key)
+                        first[position] = True
+                frontier = df.loc[first & df['COBSYSTEMID'].notnull().to_numpy(), roots + nodes]
+                fields['queried'] = len(new_nodes)
+                fields['rows'] = len(df)
+            log.info('Hop %d: %d new nodes queried, %d new rows, %d nodes to follow',
+                     hop, len(new_nodes), len(df), len(frontier))
+        return found
+
+    def combine_ucl_frames(self, df_list):
+        """
+        Combine the per-COBSYSTEM lookup results into one DataFrame. All the frames are
+        collected first and concatenated once, rather than growing one frame inside a loop
+        which re-copies every row gathered so far on each pass. The label columns are
+        stored as categoricals as they only hold a handful of distinct system names, and
+        are renamed and de-duplicated by self.postprocessor
+
+        :param df_list: iterable of DataFrames with the UCL_COLUMNS columns
+        :return: de-duplicated Pandas DataFrame
+        """
+        df_list = list(df_list)
+        if not df_list:
+            return pd.DataFrame(columns=UCL_COLUMNS)
+        df = pd.concat(df_list, ignore_index=True)
+        # drop our references so each per-system frame is freed as soon as it is copied
+        del df_list[:]
+        return self.postprocessor.process(df, LABEL_COLUMNS)
+
+    def stream_populate_cob(self, cobsystem_cobsystemid_dict):
+        """
+        Chunk-by-chunk version of populate_cob for results too large to hold in memory.
+        COBSYSTEMs are looked up one after another and every chunk is normalised and
+        de-duplicated against the rows already yielded before it is passed on, so the
+        caller can write or aggregate each chunk and then let it go.
+
+        Only a 64 bit hash of each row yielded is kept, not the row, so a row whose hash
+        equals that of a different row already yielded is dropped as a repeat. With random
+        hashes the chance of this is about 3 in 10**4 over 10**8 distinct rows. populate_cob
+        compares the rows themselves
+
+        :param cobsystem_cobsystemid_dict: dictionary of COBSYSTEM to list of COBSYSTEMIDs
+        :return: generator of Pandas DataFrames with the UCL_COLUMNS columns
+        """
+        if self.max_hops != 1:
+            # every hop needs the whole of the hop before it
+            log.warning('max_hops is %d, the result is not streamed', self.max_hops)
+            yield self.populate_cob(cobsystem_cobsystemid_dict)
+            return
+        # sorted 64 bit hashes of the rows seen so far, far smaller than the rows themselves
+        seen = np.empty(0, dtype=np.uint64)
+        for cobsystem, cobsystemid_list in cobsystem_cobsystemid_dict.items():
+            for df in self.iter_ucl_and_ucl_children(cobsystem, cobsystemid_list):
+                df = self.postprocessor.normalize_labels(df.reindex(columns=UCL_COLUMNS), LABEL_COLUMNS)
+                hashes = pd.util.hash_pandas_object(df, index=False)
+                keep = ~hashes.duplicated().to_numpy()
+                hashes = hashes.to_numpy()
+                if len(seen):
+                    positions = np.minimum(np.searchsorted(seen, hashes), len(seen) - 1)
+                    keep &= seen[positions] != hashes
+                if keep.any():
+                    new = np.sort(hashes[keep])
+                    seen = np.insert(seen, np.searchsorted(seen, new), new)
+                    yield df[keep]
+
+    @instruments.timed('populate_cob')
     def populate_cob(self, cobsystem_cobsystemid_dict):
         # TODO: Move to another class?
         """get all cob children under any UCL parent for input cobsystemid, this enables the
         collection of cobs from input and also from ucls associated with input."""
-        for j, cobsystem in enumerate(cobsystem_cobsystemid_dict):
-            cobsystemid_list = str(cobsystem_cobsystemid_dict[cobsystem])
-            print(type(cobsystemid_list),cobsystemid_list)
-            # load the first cobsystem data into a dataframe, regarless of which cobsystem it is
-            if j == 0:
-                df = self.input_cob_get_ucl_and_ucl_children(cobsystem, cobsystemid_list)
-            else:
-                # append all
-                df = pd.concat([df, self.input_cob_get_ucl_and_ucl_children(cobsystem, cobsystemid_list)])
-            print(cobsystem, j, cobsystemid_list, len(cobsystemid_list), df.shape)
-        df.replace({'DBCATParty': 'DBCAT'}, inplace=True)
-        df.drop_duplicates(inplace=True)
+        df_list = self.lookup_cobsystems(cobsystem_cobsystemid_dict).values()
+        if self.max_hops != 1:
+            df_list = self.expand_hops(df_list)
+        df = self.combine_ucl_frames(df_list)
         ###df_dict['input_plus_ucl_cob'] = df
         # df = pd.merge(df, xdiv(cobsystem,cobsystemid_list), how = 'outer', on =['Aspen','Paragon','UCL'])
-        print(df.shape, df.describe())  # df.cobsystem.unique())
+        log.info('%d rows, %d columns', df.shape[0], df.shape[1])
+        # describe reads every row, only pay for it when it will be shown
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('\n%s', df.describe())  # df.cobsystem.unique())
 
         #############################################################################
         # Get COB information from the graph for each COBSYSTEM
@@ -113,27 +711,86 @@ class Cob():
         ###df = df_dict['input_plus_ucl_cob']
 
         cobsystem_list = df.COBSYSTEM.dropna().unique()
-        print('FOUND UNIQUE COBSYSTEMS: ', cobsystem_list)
+        log.info('FOUND UNIQUE COBSYSTEMS: %s', cobsystem_list)
         return df
 
-    def functions(self):
+    def cob_details_query(self, cobsystem_party):
+        """
+        Build the query returning the properties of the COBs of one system
+
+        :param cobsystem_party: node label of the system, e.g. 'CRDSParty'
+        :return: cypher query string
+        """
+        return '''
+        UNWIND $ids AS id
+        MATCH (cob:''' + cobsystem_party + ''' {id: id})
+        RETURN cob.id as COBSYSTEMID,
+        labels(cob)[1] as COBSYSTEM,
+        properties(cob) as properties
+        '''
+
+    def return_cob_details(self, cobsystem, input_plus_ucl_cob, input_filters):
+        """
+        Get COB information from the graph for the COBs of one system found by populate_cob
+
+        :param cobsystem: name of the system, e.g. 'CRDS'
+        :param input_plus_ucl_cob: DataFrame returned by populate_cob
+        :param input_filters: COBSYSTEM values of the rows whose COBSYSTEMIDs are looked up
+        :return: Pandas DataFrame with COBSYSTEMID, COBSYSTEM and one column per property
+        """
+        df = input_plus_ucl_cob
+        ids = df.loc[df['COBSYSTEM'].isin(input_filters), 'COBSYSTEMID'].dropna().unique().tolist()
+        query = self.cob_details_query(cobsystem.upper() + 'Party')
+        df_list = [self.env.py2neo_py2_and_py3(self.graph, query, {'ids': batch})
+                   for batch in self.batches(ids)]
+        df = pd.concat(df_list, ignore_index=True) if df_list else \
+            pd.DataFrame(columns=['COBSYSTEMID', 'COBSYSTEM', 'properties'])
+        # one column per node property, properties missing from a node are left empty
+        properties = pd.DataFrame(df['properties'].tolist(), index=df.index).drop(
+            columns=['id'], errors='ignore')
+        return pd.concat([df[['COBSYSTEMID', 'COBSYSTEM']], properties], axis=1)
+
+    def return_crds(self, input_plus_ucl_cob, input_filters):
+        return self.return_cob_details('CRDS', input_plus_ucl_cob, input_filters)
+
+    def return_dbclient(self, input_plus_ucl_cob, input_filters):
+        return self.return_cob_details('DBCLIENT', input_plus_ucl_cob, input_filters)
+
+    def return_dbcat(self, input_plus_ucl_cob, input_filters):
+        return self.return_cob_details('DBCAT', input_plus_ucl_cob, input_filters)
+
+    def functions(self, cobsystem_cobsystemid_dict):
         ##############################################################################
         # Create a pipeline to keep the functions and their respective parameters clean
         ##############################################################################
+        """
+        Build the pipeline of the offboarding stages. input_plus_ucl_cob, the result of
+        populate_cob, is computed once and shared, and the enrichment stages that read it
+        run at the same time, up to self.max_workers of them. Run it with
+        Pipeline.run, e.g. functions(di).run(['return_crds'])
+
+        :param cobsystem_cobsystemid_dict: dictionary of COBSYSTEM to list of COBSYSTEMIDs
+        :return: Pipeline
+        """
         # Create a dictionary of the functions defined previously
-        # TODO: Remove (or replace) the reference to 'return_ucl_children_cobsys'
-        # TODO: Remove the reference to 'account_graph_id_filters' once dependency is not required
-        # TODO: Change the structure of code to make e.g. account_system_filters a global variable in constructor which is inherited
-        function_list = {'return_crds': return_crds,
-                         'return_dbclient': return_dbclient,
-                         'return_dbcat': return_dbcat
+        function_list = {'return_crds': self.return_crds,
+                         'return_dbclient': self.return_dbclient,
+                         'return_dbcat': self.return_dbcat
                          }
-        # Create dictionary of parameters inputted into the functions
+        # Create dictionary of parameters inputted into the functions, input_filters picks
+        # the rows of input_plus_ucl_cob each function looks up
         function_argument_list = {
-            'return_crds': {'input_filters': input_filters},
-            'return_dbclient': {'input_filters': input_filters},
-            'return_dbcat': {'input_filters': input_filters}
+            'return_crds': {'input_filters': ['CRDSParty']},
+            'return_dbclient': {'input_filters': ['DBCLIENTParty']},
+            'return_dbcat': {'input_filters': ['DBCAT', 'DBCATParty']}
         }
+        pipeline = Pipeline(self.max_workers)
+        pipeline.register('input_plus_ucl_cob', self.populate_cob,
+                          arguments={'cobsystem_cobsystemid_dict': cobsystem_cobsystemid_dict})
+        for name in sorted(function_list):
+            pipeline.register(name, function_list[name], inputs=['input_plus_ucl_cob'],
+                              arguments=function_argument_list[name])
+        return pipeline
 
 
 if __name__ == '__main__':
@@ -163,12 +820,39 @@ if __name__ == '__main__':
     i.populate_cob(di)"""
     ##############################################################################
     env_class = Env(yaml_directory,yaml_file, offboard_directory, offboard_file)
-    cob_class = Cob()
-
+    configure_logging(env_class.config.log_level)
+    instruments.configure(env_class.config)
     env_class.graph = env_class.connectToYamlGraph()
+    cob_class = Cob.from_config(env_class)
     cob_class.graph = env_class.graph
-    print(env_class.version_of_graph())
-    df_input = cob_class.load_input()
-    di = cob_class.dataframe_to_dict(df_input[['COBSYSTEM','COBSYSTEMID']])
+    log.info('Graph version:\n%s', env_class.version_of_graph())
+    di = cob_class.load_input_grouped(verbose=True)
 
-    cob_class.populate_cob(di)
\ No newline at end of file
+    config = env_class.config
+    output_file_extension = OUTPUT_EXTENSIONS.get(config.output_format, output_file_extension)
+    output_path = os.path.join(output_file_path, output_file_name
+                               + ('' if config.output_partition_by else output_file_extension))
+    pipeline = cob_class.functions(di)
+    with OutputWriter(output_path, config.output_format, config.output_partition_by,
+                      config.output_compression, LABEL_COLUMNS, UCL_COLUMNS,
+                      metadata=dict(cob_class.result_settings(), graph_version=cob_class.graph_version,
+                                    input=offboard_file)) as writer:
+        # when results are read from the graph in chunks, they are written out the same way.
+        # The result isn't kept, Config refuses stages together with chunk_size
+        if cob_class.chunk_size:
+            for df in cob_class.stream_populate_cob(di):
+                writer.write(df)
+        else:
+            # looked up in this thread, so postprocessor can fork its workers, and handed to
+            # the pipeline so the enrichment stages below reuse the result
+            df = cob_class.populate_cob(di)
+            pipeline.set_result('input_plus_ucl_cob', df)
+            writer.write(df)
+    # enrichment stages named in the configuration file, each to its own output
+    for stage, df in pipeline.run(config.stages).items():
+        with OutputWriter(os.path.join(output_file_path, output_file_name + '_' + stage + output_file_extension),
+                          config.output_format, None, config.output_compression, LABEL_COLUMNS) as writer:
+            writer.write(df)
+    # every batch finished, a later run of the same input starts afresh
+    if cob_class.checkpoint is not None and not cob_class.failed_cobsystems and not pipeline.failed:
+        cob_class.checkpoint.clear()
\ No newline at end of file
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+import os
+import threading
+import yaml
+from output import OUTPUT_EXTENSIONS
+
+# The C (libyaml) loader is several times faster, fall back to the pure python one if
+# PyYAML was built without it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Keys which must be present in the configuration file to build the graph address
+REQUIRED_KEYS = ['protocol', 'url', 'password', 'new_server', 'write_graph']
+
+# Values accepted for the backend setting, see backend.py
+BACKENDS = ['http', 'bolt']
+
+# Parsed files, keyed on (absolute path, modification time) so an edited file is re-read
+_yaml_cache = {}
+_yaml_cache_lock = threading.Lock()
+
+
+def load_yaml(file_path):
+    """
+    Parse a YAML file with the safe loader, reading it from disk only the first time it is
+    asked for or after it has been modified. Every Env in the process shares the cache
+
+    :param file_path: path of the YAML file
+    :return: dictionary of the parsed file
+    """
+    file_path = os.path.abspath(file_path)
+    key = (file_path, os.path.getmtime(file_path))
+    with _yaml_cache_lock:
+        if key not in _yaml_cache:
+            with open(file_path, 'r') as resource:
+                values = yaml.load(resource, Loader=SafeLoader) or {}
+            # forget older versions of the same file
+            for cached_key in [k for k in _yaml_cache if k[0] == file_path]:
+                del _yaml_cache[cached_key]
+            _yaml_cache[key] = values
+        return _yaml_cache[key]
+
+
+class Config():
+    """
+    Typed view of the configuration file. Optional settings fall back to a default when
+    the key is missing from the file
+    """
+
+    def __init__(self, values, file_path=None):
+        """
+        :param values: dictionary parsed from the YAML file
+        :param file_path: path the values were read from, used in error messages
+        :raises ValueError: if any of REQUIRED_KEYS is missing, or a setting has a value
+        that isn't allowed
+        """
+        missing = [key for key in REQUIRED_KEYS if values.get(key) in (None, '')]
+        if missing:
+            raise ValueError('Configuration file ' + str(file_path) + ' is missing the keys: '
+                             + ', '.join(missing))
+        self.values = values
+        self.file_path = file_path
+
+        # Graph connection
+        self.protocol = str(values['protocol'])
+        self.url = str(values['url'])
+        self.password = str(values['password'])
+        self.new_server = str(values['new_server'])
+        self.write_graph = str(values['write_graph'])
+        self.read_graph = str(values.get('read_graph', ''))
+        self.dev_graph = str(values.get('dev_graph', ''))
+
+        # Query backend, see backend.py
+        self.backend = str(values.get('backend', 'http')).lower()
+        self.bolt_port = int(values.get('bolt_port', 7687))
+        self.pool_size = int(values.get('pool_size', 50))
+        self.keep_alive = bool(values.get('keep_alive', True))
+        self.max_retries = int(values.get('max_retries', 3))
+
+        # UCL lookup, see Cob
+        self.batch_size = int(values.get('batch_size', 10000))
+        self.max_workers = int(values.get('max_workers', 1))
+        self.chunk_size = int(values['chunk_size']) if values.get('chunk_size') else None
+        # UCL hops followed from each input, 0 carries on until nothing new is found
+        self.max_hops = int(values.get('max_hops', 1))
+
+        # Local cache of lookup results, see cache.py. No cache unless a path is given
+        self.cache_path = values.get('cache_path') or None
+        self.cache_max_ids = int(values.get('cache_max_ids', 1000000))
+
+        # Offline UCL index, see ucl_index.py. Lookups go to the graph unless a directory is given
+        self.ucl_index_directory = values.get('ucl_index_directory') or None
+
+        # Resumable runs, see checkpoint.py. Nothing is spilled unless a directory is given
+        self.checkpoint_directory = values.get('checkpoint_directory') or None
+
+        # Output file, see output.py
+        self.output_format = str(values.get('output_format', 'csv')).lower()
+        self.output_partition_by = values.get('output_partition_by') or None
+        self.output_compression = str(values.get('output_compression', 'snappy'))
+
+        # Leave Cob.account_system_filters out of the results, see system_filter.py
+        self.exclude_account_systems = bool(values.get('exclude_account_systems', False))
+
+        # Clean up of the combined result, see postprocess.py. label_map renames node labels,
+        # DBCATParty to DBCAT by default, postprocess_workers de-duplicates large results on a process pool
+        self.label_map = values.get('label_map')
+        self.postprocess_workers = int(values.get('postprocess_workers', 1))
+
+        # Pipeline stages run after the lookup, see Cob.functions
+        self.stages = list(values.get('stages') or [])
+
+        # Logging and metrics, see instrumentation.py. No metrics are collected unless a sink is given
+        self.log_level = str(values.get('log_level', 'INFO')).upper()
+        self.metrics_log = bool(values.get('metrics_log', False))
+        self.metrics_jsonl = values.get('metrics_jsonl') or None
+        self.metrics_prometheus = values.get('metrics_prometheus') or None
+
+        for key, value, allowed in [('backend', self.backend, BACKENDS),
+                                    ('output_format', self.output_format, sorted(OUTPUT_EXTENSIONS))]:
+            if value not in allowed:
+                raise ValueError('Configuration file ' + str(file_path) + ' has ' + key + ': ' + value
+                                 + ', expected one of: ' + ', '.join(allowed))
+        if self.label_map is not None and not isinstance(self.label_map, dict):
+            raise ValueError('Configuration file ' + str(file_path) + ' has label_map: ' + str(self.label_map)
+                             + ', expected a mapping of node label to name')
+        if self.stages and self.chunk_size:
+            raise ValueError('Configuration file ' + str(file_path) + ' has both stages and chunk_size, '
+                             'the stages need the whole lookup result which chunk_size streams')
+        if self.max_hops < 0:
+            raise ValueError('Configuration file ' + str(file_path) + ' has max_hops: ' + str(self.max_hops)
+                             + ', expected 0 or more')
+
+    def get(self, key, default=''):
+        return self.values.get(key, default)
+
+    def graph_address(self):
+        # Concatenate sensitive information to create the graph address
+        return self.protocol + ':' + self.url + ':' + self.password + '@' + self.new_server \
+               + ':' + self.write_graph
+
+    def redacted_graph_address(self):
+        # The graph address with the password masked, safe to log
+        return self.protocol + ':' + self.url + ':****@' + self.new_server + ':' + self.write_graph
+
+
+def load_config(file_path):
+    """
+    Load and validate the configuration file
+
+    :param file_path: path of the YAML file
+    :return: Config
+    """
+    return Config(load_yaml(file_path), file_path)
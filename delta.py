@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+"""
+Incremental offboarding of a re-submitted input file against the output of an earlier run.
+Only the IDs added since the earlier run are looked up, the rows of removed IDs are
+dropped and the rows of every other ID are carried over. If the graph has been rebuilt
+since the earlier run, or it was run with other settings, e.g. max_hops or
+exclude_account_systems, its rows can't be mixed with new ones and everything is looked
+up again. The settings are read from the metadata saved with the earlier output, see
+Cob.result_settings, an output without them is always run again in full.
+"""
+import os
+import logging
+import datetime
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from batch import output_file_name, write_stages
+from cob import LABEL_COLUMNS, UCL_COLUMNS
+from output import OutputWriter, OUTPUT_EXTENSIONS, read_output, read_output_metadata
+from system_filter import normalize_system
+
+log = logging.getLogger(__name__)
+
+REPORT_COLUMNS = ['COBSYSTEM', 'mode', 'prior_ids', 'input_ids', 'added_ids', 'removed_ids',
+                  'kept_ids', 'prior_rows', 'kept_rows', 'output_rows']
+
+
+def normalized_systems(series):
+    # normalize_system of every row, working out each distinct label only once
+    codes, systems = pd.factorize(series.astype(str))
+    return np.array([normalize_system(system) for system in systems], dtype=object)[codes]
+
+
+def prior_ids(prior_df):
+    """
+    The input IDs of an earlier output, per input system. The systems are normalised, as
+    the output holds node labels, e.g. 'DBCAT' or 'CRDSParty', while the input holds
+    system names
+
+    :return: dictionary of normalised system to set of COBSYSTEMIDs
+    """
+    df = prior_df[['input_cobsystem', 'input_cobsystemid']].dropna().drop_duplicates()
+    result = {}
+    for system, ids in df['input_cobsystemid'].astype(str).groupby(normalized_systems(df['input_cobsystem'])):
+        result[system] = set(ids)
+    return result
+
+
+def current_graph_version(cob):
+    return cob.graph_version if cob.graph_version is not None else cob.env.graph_version()
+
+
+def changed_settings(cob, metadata):
+    """
+    :param cob: Cob the new run uses
+    :param metadata: metadata saved with the earlier output, see output.read_output_metadata
+    :return: list of the names of the settings of cob.result_settings the earlier run didn't share
+    """
+    return [name for name, value in cob.result_settings().items() if metadata.get(name) != value]
+
+
+def full_populate_cob(cob, cobsystem_cobsystemid_dict):
+    """
+    populate_cob, with a change report listing every ID as added
+
+    :return: tuple of (DataFrame as populate_cob returns it, DataFrame change report)
+    """
+    df = cob.populate_cob(cobsystem_cobsystemid_dict)
+    report = [OrderedDict([('COBSYSTEM', cobsystem), ('mode', 'full'),
+                           ('input_ids', len(set(cobsystemid_list))),
+                           ('added_ids', len(set(cobsystemid_list)))])
+              for cobsystem, cobsystemid_list in cobsystem_cobsystemid_dict.items()]
+    return df, pd.DataFrame(report, columns=REPORT_COLUMNS)
+
+
+def delta_populate_cob(cob, cobsystem_cobsystemid_dict, prior_df, prior_graph_version):
+    """
+    populate_cob for an input which was run before. An ID of the earlier input which found
+    nothing in the graph has no rows in its output, so it is looked up again
+
+    :param cob: Cob connected to the graph, with graph_version set
+    :param cobsystem_cobsystemid_dict: dictionary of COBSYSTEM to list of COBSYSTEMIDs
+    :param prior_df: DataFrame of the earlier output, see output.read_output
+    :param prior_graph_version: graph version the earlier output came from
+    :return: tuple of (DataFrame as populate_cob returns it, DataFrame change report)
+    """
+    graph_version = current_graph_version(cob)
+    if prior_graph_version != graph_version:
+        log.info('The graph version changed from %s to %s, running everything again',
+                 prior_graph_version, graph_version)
+        return full_populate_cob(cob, cobsystem_cobsystemid_dict)
+
+    prior = prior_ids(prior_df)
+    prior_system = normalized_systems(prior_df['input_cobsystem'])
+    prior_input_id = prior_df['input_cobsystemid'].astype(str)
+    added = OrderedDict()
+    keep = np.zeros(len(prior_df), dtype=bool)
+    report = []
+    for cobsystem, cobsystemid_list in cobsystem_cobsystemid_dict.items():
+        system = normalize_system(cobsystem)
+        ids = set(str(cobsystemid) for cobsystemid in cobsystemid_list)
+        before = prior.get(system, set())
+        added[cobsystem] = [cobsystemid for cobsystemid in cobsystemid_list if str(cobsystemid) not in before]
+        rows = (prior_system == system) & prior_input_id.isin(ids).to_numpy()
+        keep |= rows
+        report.append(OrderedDict([('COBSYSTEM', cobsystem), ('mode', 'delta'),
+                                   ('prior_ids', len(before)), ('input_ids', len(ids)),
+                                   ('added_ids', len(added[cobsystem])),
+                                   ('removed_ids', len(before - ids)), ('kept_ids', len(before & ids)),
+                                   ('prior_rows', int((prior_system == system).sum())),
+                                   ('kept_rows', int(rows.sum()))]))
+    # systems of the earlier input which are not in the new one at all
+    for system in sorted(set(prior) - set(normalize_system(cobsystem) for cobsystem in cobsystem_cobsystemid_dict)):
+        report.append(OrderedDict([('COBSYSTEM', system), ('mode', 'delta'), ('prior_ids', len(prior[system])),
+                                   ('input_ids', 0), ('added_ids', 0), ('removed_ids', len(prior[system])),
+                                   ('kept_ids', 0), ('prior_rows', int((prior_system == system).sum()))]))
+
+    added = OrderedDict((cobsystem, ids) for cobsystem, ids in added.items() if ids)
+    log.info('%d IDs added since the earlier run, %d rows carried over',
+             sum(len(ids) for ids in added.values()), int(keep.sum()))
+    df_list = [prior_df[keep]]
+    if added:
+        df_added = cob.lookup_cobsystems(added).values()
+        df_list.extend(cob.expand_hops(df_added) if cob.max_hops != 1 else df_added)
+    df = cob.combine_ucl_frames(df_list)
+
+    # rows of each input system in the merged output
+    output_rows = pd.Series(normalized_systems(df['input_cobsystem'])).value_counts()
+    report = pd.DataFrame(report, columns=REPORT_COLUMNS)
+    report['output_rows'] = [int(output_rows.get(normalize_system(system), 0)) for system in report['COBSYSTEM']]
+    return df, report
+
+
+def run_delta(cob, input_path, prior_path, output_directory, timestamp=None, output_format='csv',
+              partition_by=None, compression='snappy', prior_graph_version=None, stages=()):
+    """
+    Offboard one input file incrementally against the output of an earlier run, writing
+    the merged output and a change report next to it
+
+    :param cob: Cob connected to the graph
+    :param input_path: the re-submitted input file
+    :param prior_path: output of the earlier run, as written by OutputWriter
+    :param prior_graph_version: graph version of the earlier run, read from the metadata
+    saved with its output if not given. The earlier output is only reused when the graph
+    version and the settings of changed_settings match
+    :param stages: names of enrichment stages to run on the merged result, see batch.write_stages
+    :return: tuple of (output path, DataFrame change report)
+    """
+    metadata = read_output_metadata(prior_path)
+    if prior_graph_version is None:
+        prior_graph_version = metadata.get('graph_version')
+    changed = changed_settings(cob, metadata)
+    timestamp = timestamp or datetime.datetime.now().strftime("_%Y_%m_%d_%H_%M")
+    cob.failed_stages = OrderedDict()
+    grouped = cob.load_input_grouped(path=input_path)
+    # when the earlier output can't be used, it isn't read at all
+    if prior_graph_version != current_graph_version(cob):
+        log.info('The graph version changed from %s to %s, running everything again',
+                 prior_graph_version, current_graph_version(cob))
+        df, report = full_populate_cob(cob, grouped)
+    elif changed:
+        log.info('%s changed since the earlier run, running everything again', ', '.join(changed))
+        df, report = full_populate_cob(cob, grouped)
+    else:
+        df, report = delta_populate_cob(cob, grouped, read_output(prior_path, LABEL_COLUMNS), prior_graph_version)
+
+    output_path = os.path.join(output_directory, output_file_name(
+        input_path, timestamp, '' if partition_by else OUTPUT_EXTENSIONS[output_format]))
+    with OutputWriter(output_path, output_format, partition_by, compression, LABEL_COLUMNS, UCL_COLUMNS,
+                      metadata=dict(cob.result_settings(), graph_version=cob.graph_version,
+                                    input=input_path, prior=prior_path)) as writer:
+        writer.write(df)
+    with OutputWriter(os.path.join(output_directory, output_file_name(input_path, timestamp, '_changes.csv')),
+                      'csv') as writer:
+        writer.write(report)
+    if stages:
+        write_stages(cob, grouped, df, stages, input_path, output_directory, timestamp,
+                     output_format, compression)
+    return output_path, report
@@ -1,18 +1,17 @@
 #! /usr/bin/env python
-import py2neo
 import os
-import yaml
+import logging
 import datetime
-import pandas as pd
-from collections import defaultdict
+from backend import QueryBackend, HttpBackend, BoltBackend
+from config import load_yaml, load_config
+from instrumentation import instruments, configure_logging, redact
+
+log = logging.getLogger(__name__)
 
 class Env():
 
 
     def __init__(self,yaml_directory,yaml_file, offboard_directory, offboard_file):
-        # Set a maximum timeout period for the graph
-        py2neo.packages.httpstream.http.socket_timeout = 900
-
         self.yaml_directory = yaml_directory
         self.yaml_file = yaml_file
         self.yaml_path_file = os.path.join(yaml_directory, yaml_file)
@@ -20,25 +19,36 @@ class Env():
         self.offboard_file = offboard_file
         self.offboard_path_file = os.path.join(offboard_directory, offboard_file)
 
-    def py2neo_py2_and_py3(self, graph, query):
+    def py2neo_py2_and_py3(self, graph, query, parameters=None):
         #TODO: Should this be in the Environment Class!?
         """
         Allows the use of various version of the py2neo library, the older
         version of py2neo required more syntax to export data from a Neo4J
         database to a pandas DataFrame
 
+        :param graph: a QueryBackend, or a py2neo Graph which is run over http
         :param query: the cypher query to be ran
+        :param parameters: optional dictionary of query parameters, e.g. {'ids': [...]}.
+        Passing values as parameters keeps the query text stable so Neo4j can cache the plan
         :return: Pandas DataFrame
         """
 
-        # Older version of py2neo, more complicated syntax
-        if py2neo.__version__.startswith('2.'):
-            graph_result = graph.cypher.execute(query)
-            return pd.DataFrame(graph_result.records, columns=graph_result.columns)
-        # Newer version of py2neo, easier syntax
-        elif py2neo.__version__.startswith('3.'):
-            graph_result = graph.data(query)
-            return pd.DataFrame(graph_result)
+        # A plain py2neo graph is wrapped so both the http and bolt backends are handled alike
+        if not isinstance(graph, QueryBackend):
+            graph = HttpBackend(graph)
+        return graph.run(query, parameters)
+
+    def py2neo_stream(self, graph, query, parameters=None, chunk_size=10000):
+        """
+        Same as py2neo_py2_and_py3, but the result is read from the graph a chunk at a time,
+        so the whole result never has to be held in memory as a list of records
+
+        :param chunk_size: maximum number of rows in each DataFrame
+        :return: generator of Pandas DataFrames
+        """
+        if not isinstance(graph, QueryBackend):
+            graph = HttpBackend(graph)
+        return graph.stream(query, parameters, chunk_size)
 
     def getKeyValue(self, resource, keyName):
         """
@@ -61,44 +71,68 @@ class Env():
         :param keyName: Name of the key
         :return: Configuration and sensitive information
         """
+        # The file is parsed once and cached, asking for several keys doesn't re-read it
         try:
-            resource = open(filePath, "r")
-            resourceYAML = yaml.load(resource)
-            keyValues = self.getKeyValue(resourceYAML, keyName)
-            resource.close()
-        except (IOError, KeyError):
+            keyValues = self.getKeyValue(load_yaml(filePath), keyName)
+        except (IOError, OSError, KeyError):
             keyValues = ""
 
         return keyValues
 
+    @property
+    def config(self):
+        """
+        The validated configuration file as a Config object. Parsing is cached, so this is
+        cheap to call repeatedly and from many Env instances
+        """
+        return load_config(self.yaml_path_file)
+
     def connectToYamlGraph(self):
         """
         Connect to the relevant version of the Neo4j client graph database
         """
         # Import sensitive information for the graph
-        #yaml_path_file = os.path.join(yaml_directory, yaml_file)
-        yaml_path_file = self.yaml_path_file
-        protocol = self.getKeyValueFromYAML(yaml_path_file, 'protocol')
-        url = self.getKeyValueFromYAML(yaml_path_file, 'url')
-        password = self.getKeyValueFromYAML(yaml_path_file, 'password')
-        new_server = self.getKeyValueFromYAML(yaml_path_file, 'new_server')
-        write_graph = self.getKeyValueFromYAML(yaml_path_file, 'write_graph')
-        read_graph = self.getKeyValueFromYAML(yaml_path_file, 'read_graph')
-        dev_graph = self.getKeyValueFromYAML(yaml_path_file, 'dev_graph')
-
-        # Concatenate sensitive information to create the graph address
-        graph_address = protocol + ':' + url + ':' + password + '@' + new_server \
-                        + ':' + write_graph
-        print('The graph address is as follows:')
-        print(graph_address)
-        print()
-
-        # Connect to the graph
+        config = self.config
+
+        # Concatenate sensitive information to create the graph address, only the redacted
+        # form is ever logged
+        graph_address = config.graph_address()
+        log.info('The graph address is %s', config.redacted_graph_address())
+
+        # Connect to the graph, over bolt if the configuration file asks for it
         # TODO: Should this be in the Environment Class!?
-        graph = py2neo.Graph(graph_address,bolt=False)
-        print('Successfully connected to the graph')
+        if config.backend == 'bolt':
+            try:
+                graph = self.connectToBoltGraph(config)
+                log.info('Successfully connected to the graph over bolt')
+                return graph
+            except Exception as error:
+                log.warning('Could not connect to the graph over bolt, falling back to http: %s',
+                            redact(repr(error), config.password))
+        # py2neo is only imported once a connection is made, so validating the configuration
+        # and dry runs start quickly
+        import py2neo
+        # Set a maximum timeout period for the graph
+        py2neo.packages.httpstream.http.socket_timeout = 900
+        graph = HttpBackend(py2neo.Graph(graph_address,bolt=False))
+        log.info('Successfully connected to the graph')
         return graph
 
+    def connectToBoltGraph(self, config):
+        """
+        Connect to the graph over bolt. The optional 'bolt_port', 'pool_size', 'keep_alive'
+        and 'max_retries' keys in the YAML file tune the connection pool
+
+        :param config: Config
+        :return: BoltBackend
+        """
+        # url holds the user name in the form '//user'
+        return BoltBackend('bolt://' + config.new_server + ':' + str(config.bolt_port),
+                           config.url.lstrip('/'), config.password,
+                           pool_size=config.pool_size,
+                           keep_alive=config.keep_alive,
+                           max_retries=config.max_retries)
+
     def version_of_graph(self):
         # TODO: Should this be in the Environment Class!?
         query = """
@@ -108,6 +142,17 @@ class Env():
         """
         return self.py2neo_py2_and_py3(self.graph, query)
 
+    def graph_version(self):
+        """
+        Identify the current build of the graph, used to know when cached results are stale
+
+        :return: string of the form 'buildDate|versionNumber'
+        """
+        df = self.version_of_graph()
+        if df.empty:
+            return ''
+        return str(df['buildDate'].iloc[0]) + '|' + str(df['versionNumber'].iloc[0])
+
 if __name__ == '__main__':
     #TODO: There should be test checks here which are more generic - to test functionality.
     z_drive_coffb = r'\\DBG.ADS.DB.COM\DUB-FSU\GROUPS\OPSOSG\GRP_DATALAB\\Analytics Team'\
@@ -128,5 +173,7 @@ if __name__ == '__main__':
 
     ##############################################################################
     i = Env(yaml_directory,yaml_file, offboard_directory, offboard_file)
+    configure_logging(i.config.log_level)
+    instruments.configure(i.config)
     i.graph = i.connectToYamlGraph()
-    print(i.version_of_graph())
\ No newline at end of file
+    log.info('Graph version:\n%s', i.version_of_graph())
\ No newline at end of file
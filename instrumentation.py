@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+import os
+import json
+import time
+import atexit
+import hashlib
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# os.replace is atomic on Windows as well, python 2 only has rename
+replace = getattr(os, 'replace', os.rename)
+
+
+def configure_logging(level='INFO'):
+    """
+    Send the log records of every module to stderr with a timestamp and level
+
+    :param level: name of the lowest level shown, e.g. 'INFO' or 'DEBUG'
+    """
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO), format=LOG_FORMAT)
+
+
+def redact(text, secret, mask='****'):
+    """
+    Mask every occurrence of secret in text, so messages that might contain a password,
+    such as a connection error, can be logged
+
+    :return: string
+    """
+    text = str(text)
+    return text.replace(secret, mask) if secret else text
+
+
+def query_id(query):
+    # Short stable name for a query, the full text is too long for a log line or a label
+    return hashlib.md5(' '.join(query.split()).encode('utf-8')).hexdigest()[:12]
+
+
+def frame_bytes(df):
+    # Memory held by a result, deep so the strings in object columns are counted
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+class LogSink():
+    """
+    Writes each event to the log as one line of key=value pairs
+    """
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def emit(self, event):
+        log.log(self.level, ' '.join('%s=%s' % item for item in event.items()))
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink():
+    """
+    Appends each event to a file as one JSON object per line
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.file = open(file_path, 'a')
+
+    def emit(self, event):
+        line = json.dumps(event, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class PrometheusSink():
+    """
+    Adds the events up into counters and writes them in the Prometheus text format, for the
+    node exporter textfile collector. Each event type becomes a <prefix>_<event>_calls_total
+    counter and each numeric field a <prefix>_<event>_<field>_total counter, labelled by the
+    text fields of the event. The file is rewritten after every stage event, so a run that
+    is killed or hangs still leaves the metrics of the stages it finished, and replaced in
+    one rename, so the collector never reads it half written
+    """
+
+    def __init__(self, file_path, prefix='offboarding'):
+        self.file_path = file_path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # (metric name, labels) -> value
+        self.counters = OrderedDict()
+
+    def add(self, name, labels, value):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def emit(self, event):
+        base = self.prefix + '_' + event['event']
+        labels = tuple((key, value) for key, value in event.items()
+                       if key != 'event' and isinstance(value, str))
+        with self.lock:
+            self.add(base + '_calls_total', labels, 1)
+            for key, value in event.items():
+                if key != 'time' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.add(base + '_' + key + '_total', labels, value)
+        if event['event'] == 'stage':
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines = []
+            for name in OrderedDict.fromkeys(name for name, labels in self.counters):
+                lines.append('# TYPE ' + name + ' counter')
+                for (metric, labels), value in self.counters.items():
+                    if metric == name:
+                        lines.append(name + format_labels(labels) + ' ' + repr(value))
+            # under the lock, so two threads never write the temporary file at once
+            temporary = self.file_path + '.tmp'
+            with open(temporary, 'w') as output:
+                output.write('\n'.join(lines) + '\n')
+            replace(temporary, self.file_path)
+
+    def close(self):
+        self.flush()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels]
+    return '{' + ','.join('%s="%s"' % label for label in escaped) + '}'
+
+
+class Instrumentation():
+    """
+    Timers and query metrics, sent to any number of sinks. With no sinks every timer and
+    query hook returns straight away, so leaving the hooks in costs nothing measurable.
+    Events are ordered dictionaries with an 'event' type ('stage' or 'query'), a 'time'
+    stamp and the fields of that event
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def configure(self, config):
+        """
+        Replace the sinks with the ones asked for by the metrics_log, metrics_jsonl and
+        metrics_prometheus settings of the configuration file
+
+        :param config: Config
+        """
+        self.close()
+        if config.metrics_log:
+            self.add_sink(LogSink())
+        if config.metrics_jsonl:
+            self.add_sink(JsonLinesSink(config.metrics_jsonl))
+        if config.metrics_prometheus:
+            self.add_sink(PrometheusSink(config.metrics_prometheus))
+
+    def emit(self, event_type, fields):
+        event = OrderedDict([('event', event_type), ('time', round(time.time(), 3))])
+        event.update(fields)
+        for sink in self.sinks:
+            sink.emit(event)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """
+        Time the body of a with block as a stage event. Fields added to the yielded
+        dictionary, e.g. the number of rows produced, are sent with the event. Labels are
+        passed as text, numbers are added up as measurements by PrometheusSink
+
+            with instruments.timer('lookup', cobsystem='DBCAT') as fields:
+                fields['rows'] = len(df)
+        """
+        if not self.sinks:
+            yield {}
+            return
+        fields = OrderedDict([('stage', stage)])
+        fields.update(sorted(labels.items()))
+        start = time.time()
+        try:
+            yield fields
+        except BaseException as error:
+            fields['error'] = type(error).__name__
+            raise
+        finally:
+            fields['seconds'] = round(time.time() - start, 6)
+            self.emit('stage', fields)
+
+    def timed(self, stage):
+        """
+        Decorator timing every call of a function as a stage event
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.sinks:
+                    return function(*args, **kwargs)
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_query(self, backend, query, df, fetch_seconds, convert_seconds, server_seconds=None):
+        """
+        Send a query event: the rows and bytes returned, the time spent waiting for the
+        graph, the time spent building the DataFrame and, when the backend reports it, the
+        time the server itself spent on the query
+
+        :param backend: name of the QueryBackend
+        :param df: the resulting DataFrame
+        """
+        if not self.sinks:
+            return
+        fields = OrderedDict([('backend', backend), ('query', query_id(query)), ('mode', 'run'),
+                              ('rows', len(df)), ('bytes', frame_bytes(df)),
+                              ('seconds', round(fetch_seconds + convert_seconds, 6)),
+                              ('fetch_seconds', round(fetch_seconds, 6)),
+                              ('convert_seconds', round(convert_seconds, 6))])
+        if server_seconds is not None:
+            fields['server_seconds'] = round(server_seconds, 6)
+        self.emit('query', fields)
+
+    def metered_stream(self, backend, query, frames):
+        """
+        Pass the chunks of a streamed result through, sending one query event once the
+        stream is exhausted. Only the time spent producing chunks is counted, not the time
+        the caller spends on each one
+
+        :param frames: iterator of DataFrames
+        :return: generator of DataFrames
+        """
+        if not self.sinks:
+            for df in frames:
+                yield df
+            return
+        frames = iter(frames)
+        rows, size, seconds = 0, 0, 0.0
+        while True:
+            start = time.time()
+            df = next(frames, None)
+            seconds += time.time() - start
+            if df is None:
+                break
+            rows += len(df)
+            size += frame_bytes(df)
+            yield df
+        self.emit('query', OrderedDict([('backend', backend), ('query', query_id(query)),
+                                        ('mode', 'stream'), ('rows', rows), ('bytes', size),
+                                        ('seconds', round(seconds, 6))]))
+
+    def close(self):
+        sinks, self.sinks = self.sinks, []
+        for sink in sinks:
+            sink.close()
+
+
+# Shared by every module, sinks are added by configure or add_sink
+instruments = Instrumentation()
+atexit.register(instruments.close)
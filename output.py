@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+import io
+import os
+import json
+import shutil
+import logging
+from instrumentation import replace
+
+log = logging.getLogger(__name__)
+
+# File extension of each output format
+OUTPUT_EXTENSIONS = {'parquet': '.parquet', 'csv': '.csv'}
+
+# Writes to the network share are buffered into large sequential blocks
+BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def as_text(series):
+    # Values as strings with missing values kept as None, so every chunk has the same types
+    return series.astype(str).where(series.notnull(), None)
+
+
+def partition_file_name(value, extension):
+    # One file per partition value, named after the value
+    if value is None or (isinstance(value, float) and value != value):
+        return '__null__' + extension
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in str(value)) + extension
+
+
+def read_output_metadata(path):
+    """
+    :param path: output written by OutputWriter
+    :return: dictionary of the metadata saved with it, empty if there is none
+    """
+    if not os.path.exists(path + '.json'):
+        return {}
+    with open(path + '.json') as metadata:
+        return json.load(metadata)
+
+
+def read_output(path, dictionary_columns=()):
+    """
+    Read an output written by OutputWriter back into one DataFrame, whichever format it
+    was written in and whether or not it was partitioned
+
+    :param dictionary_columns: columns read back from CSV as categoricals
+    :return: Pandas DataFrame
+    """
+    import pandas as pd
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))] \
+        if os.path.isdir(path) else [path]
+    df_list = []
+    for part in paths:
+        if part.endswith('.parquet'):
+            df_list.append(pd.read_parquet(part))
+        elif part.endswith('.csv'):
+            # every column was written as text, empty fields were missing values
+            df = pd.read_csv(part, dtype=str)
+            df_list.append(df.astype(object).where(df.notnull(), None))
+    df = pd.concat(df_list, ignore_index=True)
+    for column in dictionary_columns:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+
+class CsvPart():
+    """
+    One CSV file, written a chunk at a time with the header before the first chunk
+    """
+
+    def __init__(self, path, **options):
+        self.path = path
+        self.file = io.open(path, 'w', buffering=BUFFER_SIZE, newline='')
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+    def close(self, columns=None):
+        if self.header and columns is not None:
+            # the header of an output with no rows
+            self.file.write(u','.join(columns) + u'\n')
+        self.file.close()
+
+
+class ParquetPart():
+    """
+    One Parquet file, with each chunk written as one or more row groups. The dictionary
+    columns are stored dictionary-encoded and read back as categoricals, the other columns
+    as strings
+    """
+
+    def __init__(self, path, compression='snappy', dictionary_columns=()):
+        # pyarrow is only needed when Parquet output is asked for
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.compression = compression
+        self.dictionary_columns = list(dictionary_columns)
+        self.file = io.open(path, 'wb', buffering=BUFFER_SIZE)
+        self.writer = None
+        self.schema = None
+
+    def open(self, columns):
+        pa = self.pa
+        self.schema = pa.schema([(column, pa.dictionary(pa.int32(), pa.string())
+                                  if column in self.dictionary_columns else pa.string())
+                                 for column in columns])
+        self.writer = self.pq.ParquetWriter(self.file, self.schema, compression=self.compression,
+                                            use_dictionary=[column for column in columns
+                                                            if column in self.dictionary_columns])
+
+    def write(self, df):
+        if self.writer is None:
+            self.open(list(df.columns))
+        arrays = []
+        for field in self.schema:
+            values = as_text(df[field.name])
+            if field.name in self.dictionary_columns:
+                arrays.append(self.pa.DictionaryArray.from_pandas(values.astype('category')).cast(field.type))
+            else:
+                arrays.append(self.pa.array(values.to_numpy(), type=field.type, from_pandas=True))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self, columns=None):
+        if self.writer is None and columns is not None:
+            self.open(list(columns))
+        if self.writer is not None:
+            self.writer.close()
+        self.file.close()
+
+
+class OutputWriter():
+    """
+    Writes a result to a Parquet or CSV file a chunk at a time, so a result streamed from
+    the graph never has to be held in memory whole. Everything is written to a temporary
+    file next to the destination and renamed into place by close, so readers on the share
+    never see a half written output and a failed run leaves the previous output alone.
+
+    With partition_by set the destination is a directory holding one file per value of that
+    column, e.g. one file per COBSYSTEM. Metadata, such as the graph version the result
+    came from, is written next to the output as <path>.json, see read_output_metadata
+
+        with OutputWriter(path, 'parquet', dictionary_columns=LABEL_COLUMNS) as writer:
+            for df in cob.stream_populate_cob(di):
+                writer.write(df)
+    """
+
+    def __init__(self, path, output_format='parquet', partition_by=None, compression='snappy',
+                 dictionary_columns=(), columns=None, metadata=None):
+        """
+        :param path: destination file, or directory when partition_by is set
+        :param output_format: 'parquet' or 'csv'
+        :param partition_by: optional column to split the output by
+        :param compression: Parquet compression codec
+        :param dictionary_columns: columns with few distinct values, dictionary-encoded in Parquet
+        :param columns: columns of an output with no rows, written when nothing else was
+        :param metadata: optional dictionary saved with the output
+        :raises ValueError: for an unknown output_format
+        """
+        if output_format not in OUTPUT_EXTENSIONS:
+            raise ValueError('Unknown output format ' + str(output_format) + ', expected one of: '
+                             + ', '.join(sorted(OUTPUT_EXTENSIONS)))
+        self.path = path
+        self.output_format = output_format
+        self.partition_by = partition_by
+        self.columns = columns
+        self.metadata = metadata
+        self.options = {} if output_format == 'csv' else \
+            {'compression': compression, 'dictionary_columns': dictionary_columns}
+        self.part_class = CsvPart if output_format == 'csv' else ParquetPart
+        self.temporary = path + '.tmp'
+        self.parts = {}
+        self.rows = 0
+        if partition_by:
+            if os.path.exists(self.temporary):
+                shutil.rmtree(self.temporary)
+            os.makedirs(self.temporary)
+        else:
+            self.parts[None] = self.part_class(self.temporary, **self.options)
+
+    def part(self, value):
+        if value not in self.parts:
+            file_name = partition_file_name(value, OUTPUT_EXTENSIONS[self.output_format])
+            self.parts[value] = self.part_class(os.path.join(self.temporary, file_name), **self.options)
+        return self.parts[value]
+
+    def write(self, df):
+        """
+        :param df: DataFrame chunk, every chunk with the same columns
+        """
+        if self.columns is None:
+            self.columns = list(df.columns)
+        if not len(df):
+            return
+        self.rows += len(df)
+        if not self.partition_by:
+            self.parts[None].write(df)
+            return
+        for value, group in df.groupby(self.partition_by, sort=False, observed=True, dropna=False):
+            self.part(value).write(group)
+
+    def close(self):
+        """
+        Finish every file and move the output into place
+
+        :return: path of the output
+        """
+        for part in self.parts.values():
+            part.close(self.columns)
+        if self.partition_by:
+            # A directory can't be renamed over another, the old output goes first
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            os.rename(self.temporary, self.path)
+        else:
+            replace(self.temporary, self.path)
+        if self.metadata is not None:
+            metadata = dict(self.metadata, rows=self.rows, output_format=self.output_format,
+                            partition_by=self.partition_by)
+            with open(self.path + '.json.tmp', 'w') as output:
+                json.dump(metadata, output, default=str)
+            replace(self.path + '.json.tmp', self.path + '.json')
+        log.info('%d rows written to %s', self.rows, self.path)
+        return self.path
+
+    def abort(self):
+        for part in self.parts.values():
+            part.file.close()
+        if os.path.isdir(self.temporary):
+            shutil.rmtree(self.temporary)
+        elif os.path.exists(self.temporary):
+            os.remove(self.temporary)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
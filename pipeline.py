@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from instrumentation import instruments
+
+log = logging.getLogger(__name__)
+
+
+class Stage():
+    """
+    One step of a Pipeline. The function is called with the results of the input stages as
+    keyword arguments named after them, plus any fixed arguments
+    """
+
+    def __init__(self, name, function, inputs=(), arguments=None):
+        """
+        :param name: name of the stage, which is also the name of its output
+        :param function: callable returning the output of the stage
+        :param inputs: names of the stages whose outputs the function takes
+        :param arguments: dictionary of further keyword arguments of the function
+        """
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.arguments = arguments or {}
+
+
+class Pipeline():
+    """
+    Registry of stages, run in dependency order. Stages whose inputs are ready run at the
+    same time on a thread pool, so independent stages, e.g. the enrichment of each source
+    system, don't wait for each other. The output of every stage is kept, so a shared
+    intermediate result is computed once however many stages use it and however many
+    times the pipeline is run. A stage that raises is recorded in self.failed and the
+    stages depending on it are skipped, the others carry on
+    """
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self.stages = OrderedDict()
+        self.results = OrderedDict()
+        # Seconds taken by, and errors raised by, each stage that has run
+        self.timings = OrderedDict()
+        self.failed = OrderedDict()
+
+    def register(self, name, function, inputs=(), arguments=None):
+        """
+        Add a stage, see Stage
+
+        :raises ValueError: if a stage of that name is already registered, or an input
+        isn't registered yet
+        """
+        if name in self.stages:
+            raise ValueError('A stage named ' + name + ' is already registered')
+        missing = [stage for stage in inputs if stage not in self.stages]
+        if missing:
+            raise ValueError('Stage ' + name + ' takes unregistered stages: ' + ', '.join(missing))
+        self.stages[name] = Stage(name, function, inputs, arguments)
+        return self.stages[name]
+
+    def required(self, targets):
+        # The targets and every stage they depend on, in registration order
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError('Unknown stage ' + name)
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].inputs)
+        return [name for name in self.stages if name in needed]
+
+    def run_stage(self, stage):
+        start = time.time()
+        with instruments.timer('pipeline_stage', pipeline_stage=stage.name):
+            arguments = dict((name, self.results[name]) for name in stage.inputs)
+            arguments.update(stage.arguments)
+            result = stage.function(**arguments)
+        return result, time.time() - start
+
+    def run(self, targets=None):
+        """
+        Run the target stages, and any stage they need whose output isn't known yet
+
+        :param targets: names of the stages wanted, every stage by default
+        :return: OrderedDict of stage name to output, for the targets that succeeded
+        """
+        targets = list(self.stages) if targets is None else list(targets)
+        todo = [name for name in self.required(targets) if name not in self.results]
+        # stages which failed in an earlier run are tried again
+        for name in todo:
+            self.failed.pop(name, None)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            while todo or running:
+                for name in list(todo):
+                    inputs = self.stages[name].inputs
+                    if any(stage in self.failed for stage in inputs):
+                        log.error('Skipping stage %s, an input stage failed', name)
+                        self.failed[name] = None
+                        todo.remove(name)
+                    elif all(stage in self.results for stage in inputs):
+                        running[executor.submit(self.run_stage, self.stages[name])] = name
+                        todo.remove(name)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name], self.timings[name] = future.result()
+                    except Exception as error:
+                        log.error('Stage %s FAILED: %r', name, error)
+                        self.failed[name] = error
+                        continue
+                    log.info('Stage %s finished in %.2fs', name, self.timings[name])
+        return OrderedDict((name, self.results[name]) for name in targets if name in self.results)
+
+    def set_result(self, name, result):
+        """
+        Record the output of a stage computed outside the pipeline, so the stages taking it
+        start from it rather than running the stage again
+
+        :raises ValueError: if no stage of that name is registered
+        """
+        if name not in self.stages:
+            raise ValueError('Unknown stage ' + name)
+        # whatever was computed from an earlier output of the stage is stale
+        self.invalidate(name)
+        self.results[name] = result
+
+    def invalidate(self, name=None):
+        """
+        Forget the output of a stage and of every stage depending on it, or of all stages,
+        so the next run computes them again
+        """
+        if name is None:
+            self.results.clear()
+            self.failed.clear()
+            return
+        stale = set([name])
+        for stage in self.stages.values():
+            if stale.intersection(stage.inputs):
+                stale.add(stage.name)
+        for stage in stale:
+            self.results.pop(stage, None)
+            self.failed.pop(stage, None)
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+import logging
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Node labels renamed in the results, DBCAT input nodes are labelled DBCATParty
+DEFAULT_LABEL_MAP = {'DBCATParty': 'DBCAT'}
+
+# Frames with fewer rows are de-duplicated in the calling process, starting workers costs more
+MIN_PARALLEL_ROWS = 1000000
+
+# The frame being de-duplicated, inherited by forked workers instead of being pickled to them
+_frame = None
+
+
+def _hash_rows(start, stop):
+    return pd.util.hash_pandas_object(_frame.iloc[start:stop], index=False).to_numpy()
+
+
+def _first_rows(positions):
+    # positions of the rows of one partition which are not repeats of an earlier row
+    part = _frame.iloc[positions]
+    return positions[~part.duplicated().to_numpy()]
+
+
+def fork_context():
+    # Workers can only share the frame when they are forked, e.g. not on Windows
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+
+class PostProcessor():
+    """
+    Clean up of the combined lookup result: node labels are renamed with label_map, then
+    repeated rows are dropped. The labels are recoded on the categories of each label
+    column, so each distinct label is looked at once rather than every row being searched.
+
+    Large frames are de-duplicated on a process pool. The rows are hashed in slices, split
+    into max_workers partitions by hash, so equal rows always share a partition, and each
+    partition is de-duplicated on its own. The workers are forked and read the frame they
+    inherit, only row positions and hashes are passed between processes. A process is only
+    forked while no other thread is running, as a lock held by another thread at the fork,
+    e.g. a logging lock, would never be released in the workers; otherwise the frame is
+    de-duplicated in this process. The rows kept are exactly those drop_duplicates keeps,
+    in the same order and with the same index
+    """
+
+    def __init__(self, label_map=None, max_workers=1, min_parallel_rows=MIN_PARALLEL_ROWS):
+        """
+        :param label_map: dictionary of node label to the name used in the results,
+        DEFAULT_LABEL_MAP by default
+        :param max_workers: number of processes de-duplicating, 1 keeps it in this process
+        :param min_parallel_rows: smallest frame de-duplicated on the process pool
+        """
+        self.label_map = dict(DEFAULT_LABEL_MAP if label_map is None else label_map)
+        self.max_workers = max_workers
+        self.min_parallel_rows = min_parallel_rows
+
+    def normalize_labels(self, df, columns):
+        """
+        Rename the labels in columns and store the columns as categoricals, with their
+        categories sorted as astype('category') sorts them
+
+        :param df: Pandas DataFrame, changed in place
+        :param columns: names of the label columns
+        :return: df
+        """
+        for column in columns:
+            values = df[column]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            categories = [self.label_map.get(label, label) for label in values.cat.categories]
+            # two labels may be renamed to the same name, their codes are merged
+            new_categories = sorted(set(categories))
+            recode = np.array([new_categories.index(label) for label in categories] + [-1], dtype=np.int64)
+            codes = recode[values.cat.codes.to_numpy()]
+            df[column] = pd.Categorical.from_codes(codes, new_categories)
+        return df
+
+    def deduplicate(self, df):
+        """
+        :param df: Pandas DataFrame
+        :return: the rows of df drop_duplicates would keep
+        """
+        context = fork_context()
+        if self.max_workers <= 1 or len(df) < self.min_parallel_rows or context is None:
+            return df.drop_duplicates()
+        if threading.active_count() > 1:
+            log.debug('%d threads are running, de-duplicating in this process', threading.active_count())
+            return df.drop_duplicates()
+        global _frame
+        _frame = df
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context) as executor:
+                step = -(-len(df) // self.max_workers)
+                hashes = np.concatenate(list(executor.map(
+                    _hash_rows, range(0, len(df), step), range(step, len(df) + step, step))))
+                partition = hashes % np.uint64(self.max_workers)
+                # stable, so each partition keeps the rows in their original order
+                order = np.argsort(partition, kind='stable')
+                bounds = np.searchsorted(partition[order], np.arange(1, self.max_workers, dtype=np.uint64))
+                keep = np.zeros(len(df), dtype=bool)
+                for positions in executor.map(_first_rows, np.split(order, bounds)):
+                    keep[positions] = True
+        finally:
+            _frame = None
+        log.debug('%d of %d rows kept by %d workers', keep.sum(), len(df), self.max_workers)
+        return df[keep]
+
+    def process(self, df, columns):
+        """
+        :param df: Pandas DataFrame, its label columns are changed in place
+        :param columns: names of the label columns
+        :return: de-duplicated DataFrame with the labels renamed
+        """
+        return self.deduplicate(self.normalize_labels(df, columns))
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+"""
+Compare the single-pass UCL lookup query with the legacy UNION query on a real graph. For
+each COBSYSTEM both queries are run with the same IDs, their results are checked to be
+identical and, over bolt, the db hits of each query are reported from PROFILE.
+
+    python query_check.py yaml_directory yaml_file offboard_directory offboard_file
+    python query_check.py yaml_directory yaml_file --fixture
+
+--fixture writes a small throwaway graph with the QueryCheck label, checks against it and
+deletes it again. Only point it at a local or development graph.
+"""
+import sys
+import time
+import argparse
+import pandas as pd
+from collections import OrderedDict
+from env import Env
+from cob import Cob, UCL_COLUMNS
+from backend import QueryBackend
+
+# Every fixture node has the QueryCheck label first, so labels(n)[1] is its Party label
+FIXTURE_QUERY = '''
+CREATE
+(u1:QueryCheck:UCL {id: 'QC-U1'}),
+(u2:QueryCheck:UCL {id: 'QC-U2'}),
+(u3:QueryCheck:UCL {id: 'QC-U3'}),
+(a1:QueryCheck:QCHECKAParty {id: 'QC-A1'}),
+(a2:QueryCheck:QCHECKAParty {id: 'QC-A2'}),
+(a3:QueryCheck:QCHECKAParty {id: 'QC-A3'}),
+(a4:QueryCheck:QCHECKAParty {id: 'QC-A4'}),
+(b1:QueryCheck:QCHECKBParty {id: 'QC-B1'}),
+(b2:QueryCheck:QCHECKBParty {id: 'QC-B2'}),
+(c1:QueryCheck:QCHECKCParty {id: 'QC-C1'}),
+(a1)-[:PRIMARY]->(u1), (b1)-[:SECONDARY]->(u1), (b2)-[:PRIMARY]->(u1),
+(a2)-[:PRIMARY]->(u2), (a4)-[:PRIMARY]->(u2), (a4)-[:SECONDARY]->(u3), (c1)-[:PRIMARY]->(u3)
+'''
+# QC-A3 has no UCL and QC-A5 and QC-B3 are not in the graph at all
+FIXTURE_INPUT = OrderedDict([('qchecka', ['QC-A1', 'QC-A2', 'QC-A3', 'QC-A4', 'QC-A5']),
+                             ('qcheckb', ['QC-B1', 'QC-B3'])])
+FIXTURE_CLEANUP_QUERY = 'MATCH (n:QueryCheck) DETACH DELETE n'
+
+
+def canonical(df):
+    """
+    Put a lookup result in a fixed column and row order, so two results can be compared
+    whatever order the graph returned the rows in
+    """
+    df = df.reindex(columns=UCL_COLUMNS).astype(object).fillna('null').astype(str)
+    return df.sort_values(UCL_COLUMNS).reset_index(drop=True)
+
+
+def compare_lookup_queries(cob, cobsystem_cobsystemid_dict):
+    """
+    Run the legacy and the single-pass lookup query for each COBSYSTEM
+
+    :param cob: Cob connected to the graph
+    :param cobsystem_cobsystemid_dict: dictionary of COBSYSTEM to list of COBSYSTEMIDs
+    :return: list of dictionaries, one per COBSYSTEM
+    """
+    report = []
+    for cobsystem, cobsystemid_list in cobsystem_cobsystemid_dict.items():
+        cobsystem_party = cobsystem.upper() + 'Party'
+        parameters = {'ids': list(OrderedDict.fromkeys(cobsystemid_list))}
+        row = OrderedDict([('cobsystem', cobsystem_party), ('ids', len(parameters['ids']))])
+        results = {}
+        for name, query in [('legacy', cob.legacy_ucl_lookup_query(cobsystem_party)),
+                            ('single_pass', cob.ucl_lookup_query(cobsystem_party))]:
+            start = time.time()
+            results[name] = canonical(cob.env.py2neo_py2_and_py3(cob.graph, query, parameters))
+            row[name + '_seconds'] = round(time.time() - start, 3)
+            row[name + '_rows'] = len(results[name])
+            if isinstance(cob.graph, QueryBackend):
+                row[name + '_db_hits'] = cob.graph.profile(query, parameters)
+        row['identical'] = results['legacy'].equals(results['single_pass'])
+        report.append(row)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the legacy and single-pass UCL lookup queries')
+    parser.add_argument('yaml_directory')
+    parser.add_argument('yaml_file')
+    parser.add_argument('offboard_directory', nargs='?', default='')
+    parser.add_argument('offboard_file', nargs='?', default='')
+    parser.add_argument('--fixture', action='store_true',
+                        help='check against a small throwaway graph instead of an input file')
+    args = parser.parse_args()
+
+    env_class = Env(args.yaml_directory, args.yaml_file, args.offboard_directory, args.offboard_file)
+    env_class.graph = env_class.connectToYamlGraph()
+    cob_class = Cob(env_class)
+    cob_class.graph = env_class.graph
+
+    if args.fixture:
+        env_class.py2neo_py2_and_py3(env_class.graph, FIXTURE_QUERY)
+        try:
+            report = compare_lookup_queries(cob_class, FIXTURE_INPUT)
+        finally:
+            env_class.py2neo_py2_and_py3(env_class.graph, FIXTURE_CLEANUP_QUERY)
+    else:
+        di = cob_class.load_input_grouped()
+        cob_class.check_id_indexes(di.keys())
+        report = compare_lookup_queries(cob_class, di)
+
+    print(pd.DataFrame(report).to_string(index=False))
+    sys.exit(0 if all(row['identical'] for row in report) else 1)
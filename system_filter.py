@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+import re
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def normalize_system(name):
+    """
+    Reduce a system name or node label to a canonical form, so 'DB CAT', 'DBCAT' and
+    'DBCATParty' all compare equal
+
+    :return: upper case string of letters and digits only
+    """
+    name = re.sub(r'[^0-9A-Z]', '', str(name).upper())
+    return name[:-len('PARTY')] if name.endswith('PARTY') and len(name) > len('PARTY') else name
+
+
+class AccountSystemFilter():
+    """
+    Set of COBSYSTEMs to leave out of the results. The names are normalised once, then
+    used two ways: as the $excluded query parameter, a list of the node labels the names
+    are usually spelt as, so the graph never returns rows for them, and as a vectorised
+    mask over a result, which catches any label spelt some other way
+    """
+
+    def __init__(self, names):
+        """
+        :param names: system names, e.g. Cob.account_system_filters
+        """
+        self.names = list(names)
+        self.normalized = frozenset(normalize_system(name) for name in self.names)
+        # 'DB CAT' may be labelled DBCATParty, DB_CATParty or DB CATParty
+        spellings = set()
+        for name in self.names:
+            for spelling in (name, name.upper(), name.replace(' ', ''), name.upper().replace(' ', ''),
+                             name.replace(' ', '_'), name.upper().replace(' ', '_')):
+                spellings.update([spelling, spelling + 'Party'])
+        self.labels = sorted(spellings)
+
+    def signature(self):
+        # Short name of the set of systems, results filtered differently must not be mixed
+        return hashlib.md5('|'.join(sorted(self.normalized)).encode('utf-8')).hexdigest()[:12]
+
+    def mask(self, series):
+        """
+        :param series: Pandas Series of system names or node labels, e.g. the COBSYSTEM column
+        :return: NumPy boolean array, True for the rows of an excluded system
+        """
+        # Only the distinct values are normalised, every row is then a lookup by code
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes, values = series.cat.codes.to_numpy(), series.cat.categories
+        else:
+            codes, values = pd.factorize(series)
+        excluded = np.array([normalize_system(value) in self.normalized for value in values] + [False],
+                            dtype=bool)
+        # code -1, a missing value, picks the trailing False
+        return excluded[codes]
+
+    def apply(self, df, column='COBSYSTEM'):
+        """
+        :return: the rows of df whose column isn't an excluded system
+        """
+        if not len(df):
+            return df
+        return df[~self.mask(df[column])]
@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+import os
+import re
+import json
+import logging
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# Every node that can be an input (any Party label) or a COB (anything next to a UCL)
+NODE_EXPORT_QUERY = '''
+MATCH (p)
+WHERE any(label IN labels(p) WHERE label ENDS WITH 'Party')
+OR (p)-[:PRIMARY|SECONDARY]-(:UCL)
+RETURN id(p) AS node, labels(p) AS labels, p.id AS node_id
+'''
+
+# Every Party to UCL edge, PRIMARY and SECONDARY are not told apart by the lookup
+EDGE_EXPORT_QUERY = '''
+MATCH (p)-[:PRIMARY|SECONDARY]-(u:UCL)
+RETURN DISTINCT id(p) AS node, id(u) AS ucl, u.id AS ucl_id
+'''
+
+# Arrays making up an index, each saved to <name>.npy in the index directory
+ARRAYS = ['strings', 'labels', 'node_id', 'node_label', 'keys', 'key_node', 'ucl_id',
+          'node_ucl_indptr', 'node_ucl', 'ucl_node_indptr', 'ucl_node']
+
+
+def intern(values, table):
+    """
+    Replace each value by its position in the sorted array table, -1 for missing values
+
+    :param values: Pandas Series
+    :param table: sorted NumPy unicode array holding every non-missing value
+    :return: NumPy int64 array
+    """
+    codes = np.full(len(values), -1, dtype=np.int64)
+    present = values.notnull().to_numpy()
+    if present.any():
+        codes[present] = np.searchsorted(table, values[present].astype(str).to_numpy(dtype=str))
+    return codes
+
+
+def csr(rows, columns, n_rows):
+    """
+    Compressed sparse row adjacency: the neighbours of row r are
+    neighbours[indptr[r]:indptr[r + 1]]
+
+    :return: tuple of (indptr, neighbours) NumPy arrays
+    """
+    order = np.argsort(rows, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_rows))]).astype(np.int64)
+    return indptr, columns[order]
+
+
+def ranges(starts, counts):
+    """
+    Concatenation of range(start, start + count) for each start and count, without a loop
+    """
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+def expand(indptr, rows):
+    """
+    Positions of the neighbours of each of rows in a CSR neighbours array, one after another
+
+    :return: tuple of (positions, number of neighbours of each row)
+    """
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    return ranges(starts, counts), counts
+
+
+class UclIndex():
+    """
+    Offline copy of the Party to UCL edges of one graph version, held as integer arrays.
+    Node ids and labels are interned into sorted string tables, the edges are stored in
+    both directions as CSR adjacency arrays, and saved indexes are memory-mapped rather
+    than read into memory. resolve gives the same rows as Cob.ucl_lookup_query without
+    going to the graph.
+
+    Ids are stored as text, the type the input IDs are sent to the graph as
+    """
+
+    def __init__(self, arrays, graph_version=''):
+        self.graph_version = graph_version
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def export(cls, env, graph, graph_version='', chunk_size=100000):
+        """
+        Read every Party node and Party to UCL edge from the graph and build an index
+
+        :param env: Env used to run the export queries
+        :param graph: graph or QueryBackend to export from
+        :return: UclIndex
+        """
+        nodes = pd.concat(list(env.py2neo_stream(graph, NODE_EXPORT_QUERY, None, chunk_size)) or
+                          [pd.DataFrame(columns=['node', 'labels', 'node_id'])], ignore_index=True)
+        edges = pd.concat(list(env.py2neo_stream(graph, EDGE_EXPORT_QUERY, None, chunk_size)) or
+                          [pd.DataFrame(columns=['node', 'ucl', 'ucl_id'])], ignore_index=True)
+        return cls.build(nodes, edges, graph_version)
+
+    @classmethod
+    def build(cls, nodes, edges, graph_version=''):
+        """
+        :param nodes: DataFrame with node (internal id), labels (list) and node_id columns
+        :param edges: DataFrame with node, ucl (internal ids) and ucl_id columns
+        :return: UclIndex
+        """
+        nodes = nodes.drop_duplicates('node').sort_values('node').reset_index(drop=True)
+        edges = edges.drop_duplicates(['node', 'ucl'])
+        # The lookup reports labels(n)[1] as the system of a node, but matches on any label
+        display_label = nodes['labels'].map(lambda labels: labels[1] if len(labels) > 1 else None)
+        party_labels = nodes['labels'].map(lambda labels: [label for label in labels
+                                                           if label.endswith('Party')])
+
+        strings = np.unique(pd.concat([nodes['node_id'], edges['ucl_id']]).dropna()
+                            .astype(str).to_numpy(dtype=str))
+        labels = np.unique(np.array(list(display_label.dropna()) +
+                                    [label for labels in party_labels for label in labels], dtype=str))
+
+        # (Party label, id) of each node, packed into one sortable integer
+        node_id = intern(nodes['node_id'], strings)
+        key_label = party_labels.explode().dropna()
+        key_node = key_label.index.to_numpy(dtype=np.int64)
+        key_id = node_id[key_node]
+        matchable = key_id >= 0
+        keys = intern(key_label, labels)[matchable] * max(len(strings), 1) + key_id[matchable]
+        order = np.argsort(keys, kind='stable')
+
+        ucls = edges[['ucl', 'ucl_id']].drop_duplicates('ucl').sort_values('ucl')
+        ucl_internal = ucls['ucl'].to_numpy(dtype=np.int64)
+        node_internal = nodes['node'].to_numpy(dtype=np.int64)
+        edge_node = np.searchsorted(node_internal, edges['node'].to_numpy(dtype=np.int64))
+        edge_ucl = np.searchsorted(ucl_internal, edges['ucl'].to_numpy(dtype=np.int64))
+        node_ucl_indptr, node_ucl = csr(edge_node, edge_ucl, len(nodes))
+        ucl_node_indptr, ucl_node = csr(edge_ucl, edge_node, len(ucls))
+
+        return cls({'strings': strings,
+                    'labels': labels,
+                    'node_id': node_id,
+                    'node_label': intern(display_label, labels),
+                    'keys': keys[order],
+                    'key_node': key_node[matchable][order],
+                    'ucl_id': intern(ucls['ucl_id'], strings),
+                    'node_ucl_indptr': node_ucl_indptr,
+                    'node_ucl': node_ucl,
+                    'ucl_node_indptr': ucl_node_indptr,
+                    'ucl_node': ucl_node}, graph_version)
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'meta.json'), 'w') as meta:
+            json.dump({'graph_version': self.graph_version}, meta)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'meta.json')) as meta:
+            graph_version = json.load(meta)['graph_version']
+        return cls(dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+                        for name in ARRAYS), graph_version)
+
+    @classmethod
+    def for_version(cls, env, graph, root_directory, graph_version):
+        """
+        Load the index of the given graph version from root_directory, exporting it from
+        the graph first if it hasn't been built yet
+
+        :return: UclIndex
+        """
+        directory = os.path.join(root_directory, re.sub(r'[^\w.-]', '_', graph_version) or 'unversioned')
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            return cls.load(directory)
+        log.info('Exporting the UCL index for graph version %s', graph_version)
+        index = cls.export(env, graph, graph_version)
+        index.save(directory)
+        return index
+
+    def text(self, codes, table):
+        # Turn interned codes back into strings, with None for -1. Each distinct code is
+        # converted once and the results are repeated, rather than converting every row
+        if not len(table):
+            return np.full(len(codes), None, dtype=object)
+        inverse, distinct = pd.factorize(codes)
+        values = np.asarray(table)[np.maximum(distinct, 0)].astype(object)
+        values[distinct < 0] = None
+        return values[inverse]
+
+    def categories(self, codes):
+        # Labels are few, so they are returned as a categorical without building strings
+        return pd.Categorical.from_codes(codes, categories=np.asarray(self.labels).astype(object))
+
+    def resolve(self, cobsystem_party, cobsystemid_list):
+        """
+        Offline equivalent of running Cob.ucl_lookup_query for the IDs
+
+        :param cobsystem_party: node label of the input system, e.g. 'DBCATParty'
+        :param cobsystemid_list: list of COBSYSTEMIDs
+        :return: Pandas DataFrame with the same columns and rows as the query
+        """
+        columns = ['UCL_ID', 'input_cobsystemid', 'input_cobsystem', 'COBSYSTEMID', 'COBSYSTEM']
+        ids = np.asarray(pd.unique(pd.Series(cobsystemid_list, dtype=object).astype(str)), dtype=str)
+        label = np.searchsorted(self.labels, cobsystem_party)
+        if len(ids) == 0 or len(self.strings) == 0 or label >= len(self.labels) \
+                or self.labels[label] != cobsystem_party:
+            return pd.DataFrame(columns=columns)
+
+        # Input nodes: find each ID in the string table, then (label, id) in the keys
+        positions = np.minimum(np.searchsorted(self.strings, ids), len(self.strings) - 1)
+        found = positions[self.strings[positions] == ids]
+        keys = label * len(self.strings) + found
+        left = np.searchsorted(self.keys, keys, 'left')
+        right = np.searchsorted(self.keys, keys, 'right')
+        inputs = np.asarray(self.key_node)[ranges(left, right - left)]
+
+        # input -> UCL -> COB, one row per path
+        positions, ucl_counts = expand(np.asarray(self.node_ucl_indptr), inputs)
+        pair_input = np.repeat(inputs, ucl_counts)
+        pair_ucl = np.asarray(self.node_ucl)[positions]
+        positions, cob_counts = expand(np.asarray(self.ucl_node_indptr), pair_ucl)
+        row_input = np.concatenate([np.repeat(pair_input, cob_counts), inputs[ucl_counts == 0]])
+        row_ucl = np.repeat(pair_ucl, cob_counts)
+        row_cob = np.concatenate([np.asarray(self.ucl_node)[positions], inputs[ucl_counts == 0]])
+        # Inputs without a UCL are their own COB, with no UCL_ID
+        ucl_codes = np.concatenate([np.asarray(self.ucl_id)[row_ucl],
+                                    np.full((ucl_counts == 0).sum(), -1, dtype=np.int64)])
+
+        # DISTINCT on the integer codes, far cheaper than on the strings they stand for
+        node_id = np.asarray(self.node_id)
+        node_label = np.asarray(self.node_label)
+        codes = pd.DataFrame({'UCL_ID': ucl_codes,
+                              'input_cobsystemid': node_id[row_input],
+                              'input_cobsystem': node_label[row_input],
+                              'COBSYSTEMID': node_id[row_cob],
+                              'COBSYSTEM': node_label[row_cob]},
+                             columns=columns).drop_duplicates()
+        return pd.DataFrame(OrderedDict(
+            (column, self.categories(codes[column].to_numpy()) if column in ('input_cobsystem', 'COBSYSTEM')
+             else self.text(codes[column].to_numpy(), self.strings)) for column in columns),
+            columns=columns).reset_index(drop=True)